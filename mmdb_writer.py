@@ -1,14 +1,29 @@
 __version__ = "0.2.6"
 
+import bisect
+import contextlib
+import functools
+import hashlib
+import ipaddress
 import logging
 import math
+import os
+import re
 import struct
+import sys
 import time
+import weakref
+from array import array
 from decimal import Decimal
 from enum import IntEnum
-from typing import Literal, Union
+from typing import TYPE_CHECKING, Literal, NamedTuple, Union
 
-from netaddr import IPNetwork, IPSet
+if TYPE_CHECKING:
+    from netaddr import IPSet
+
+# Modules only needed by optional features (asyncio, concurrent.futures, netaddr,
+# compression, spilling, state files and readers) are imported where they are
+# used, to keep importing this module fast.
 
 
 class MmdbBaseType:
@@ -52,6 +67,59 @@ class MmdbU128(MmdbBaseType):
         super().__init__(value)
 
 
+class MmdbRaw(MmdbBaseType):
+    """
+    An already encoded MMDB data section value, copied to the output verbatim.
+
+    The bytes must hold exactly one value without pointers, use
+    :meth:`from_section` to copy a value that contains pointers.
+    """
+
+    def __init__(self, value: bytes):
+        value = bytes(value)
+        if _skip_value(value, 0) != len(value):
+            raise ValueError("raw value has trailing bytes")
+        super().__init__(value)
+        self.parts = (value,)
+
+    @classmethod
+    def from_section(cls, section, offset: int, memo: dict = None) -> "MmdbRaw":
+        """
+        Copies the value at `offset` of a data section, e.g. of another database.
+
+        Pointers are resolved against `section`. Every value they point to becomes
+        a nested MmdbRaw that the encoder stores, deduplicates and points to on its
+        own. Pass the same `memo` dict to calls on the same section to share those
+        nested values.
+        """
+        if memo is None:
+            memo = {}
+        if offset in memo:
+            if memo[offset] is None:
+                raise ValueError(f"pointer loop at data offset {offset}")
+            return memo[offset]
+        memo[offset] = None
+
+        parts = []
+        last = offset
+
+        def on_pointer(start, end, target):
+            nonlocal last
+            if start > last:
+                parts.append(bytes(section[last:start]))
+            parts.append(cls.from_section(section, target, memo))
+            last = end
+
+        end = _skip_value(section, offset, on_pointer)
+        if end > last:
+            parts.append(bytes(section[last:end]))
+        raw = cls.__new__(cls)
+        MmdbBaseType.__init__(raw, bytes(section[offset:end]))
+        raw.parts = tuple(parts)
+        memo[offset] = raw
+        return raw
+
+
 MMDBType = Union[
     dict,
     list,
@@ -66,12 +134,23 @@ MMDBType = Union[
     MmdbU32,
     MmdbU64,
     MmdbU128,
+    MmdbRaw,
 ]
 
 logger = logging.getLogger(__name__)
 
 METADATA_MAGIC = b"\xab\xcd\xefMaxMind.com"
 
+STATE_MAGIC = b"MMDBWST\x01"
+# magic, node count, leaf count, value table length
+_STATE_HEADER = struct.Struct("<8sIIQ")
+
+SPILL_BUFFER_SIZE = 1 << 20
+# nodes written between two steps of TreeWriter.iter_write
+WRITE_CHUNK_NODES = 1 << 16
+# values encoded by MMDBWriter.plan(exact=False) to estimate the data section
+PLAN_SAMPLE_VALUES = 1024
+
 
 class MMDBTypeID(IntEnum):
     POINTER = 1
@@ -95,11 +174,154 @@ UINT16_MAX = 0xFFFF
 UINT32_MAX = 0xFFFFFFFF
 UINT64_MAX = 0xFFFFFFFFFFFFFFFF
 
+# largest payload of the integer types, leading zero bytes may be left out
+_MAX_SIZE = {
+    MMDBTypeID.UINT16: 2,
+    MMDBTypeID.UINT32: 4,
+    MMDBTypeID.INT32: 4,
+    MMDBTypeID.UINT64: 8,
+    MMDBTypeID.UINT128: 16,
+    MMDBTypeID.BOOLEAN: 1,
+}
+# payload of the floating point types, which is always complete
+_FLOAT_SIZE = {
+    MMDBTypeID.DOUBLE: 8,
+    MMDBTypeID.FLOAT: 4,
+}
+
+
+def _read_control(buf, pos):
+    """
+    Reads the control byte(s) of the data field at `pos`.
+
+    Returns:
+        (type_id, size, pos) where `pos` is the start of the payload. For
+        pointers `size` is the offset pointed to.
+    """
+    try:
+        ctrl = buf[pos]
+        pos += 1
+        type_id = ctrl >> 5
+        if type_id == MMDBTypeID.POINTER:
+            size = (ctrl >> 3) & 0x3
+            if size == 3:
+                pointer = int.from_bytes(buf[pos : pos + 4], "big")
+            else:
+                pointer = (ctrl & 0x7) << (8 * (size + 1))
+                pointer += int.from_bytes(buf[pos : pos + size + 1], "big")
+                pointer += (0, 2048, 526336)[size]
+            pos += size + 1
+            if pos > len(buf):
+                raise IndexError
+            return type_id, pointer, pos
+        if type_id == 0:
+            type_id = buf[pos] + 7
+            pos += 1
+            if type_id <= MMDBTypeID.MAP:
+                raise ValueError(f"invalid extended type at {pos - 1}")
+
+        size = ctrl & 0x1F
+        if size >= 29:
+            length = size - 28
+            if pos + length > len(buf):
+                raise IndexError
+            size = (29, 285, 65821)[length - 1]
+            size += int.from_bytes(buf[pos : pos + length], "big")
+            pos += length
+        return type_id, size, pos
+    except IndexError:
+        raise ValueError(f"truncated data field at {pos}") from None
+
+
+def _skip_value(buf, pos, on_pointer=None):
+    """
+    Validates the value at `pos` and returns where it ends.
+
+    Pointers are passed to `on_pointer(start, end, target)`, without it they are
+    rejected.
+    """
+    start = pos
+    type_id, size, pos = _read_control(buf, pos)
+    if type_id == MMDBTypeID.POINTER:
+        if on_pointer is None:
+            raise ValueError(f"unexpected pointer at {start}")
+        on_pointer(start, pos, size)
+        return pos
+    elif type_id == MMDBTypeID.MAP:
+        for _ in range(size * 2):
+            pos = _skip_value(buf, pos, on_pointer)
+        return pos
+    elif type_id == MMDBTypeID.ARRAY:
+        for _ in range(size):
+            pos = _skip_value(buf, pos, on_pointer)
+        return pos
+    elif type_id == MMDBTypeID.BOOLEAN:
+        if size > 1:
+            raise ValueError(f"invalid boolean at {start}")
+        return pos
+    elif (
+        type_id in (MMDBTypeID.STRING, MMDBTypeID.BYTES)
+        or (type_id in _MAX_SIZE and size <= _MAX_SIZE[type_id])
+        or _FLOAT_SIZE.get(type_id) == size
+    ):
+        if pos + size > len(buf):
+            raise ValueError(f"truncated data field at {start}")
+        return pos + size
+    raise ValueError(f"invalid data field of type {type_id} size {size} at {start}")
+
+
+def _decode(buf, pos, base=0):
+    """
+    Decodes the value at `pos` to plain python types.
+
+    Pointers are relative to `base`. Returns the value and where it ends.
+    """
+    start = pos
+    type_id, size, pos = _read_control(buf, pos)
+    if type_id == MMDBTypeID.POINTER:
+        return _decode(buf, base + size, base)[0], pos
+    elif type_id == MMDBTypeID.MAP:
+        res = {}
+        for _ in range(size):
+            key, pos = _decode(buf, pos, base)
+            res[key], pos = _decode(buf, pos, base)
+        return res, pos
+    elif type_id == MMDBTypeID.ARRAY:
+        res = []
+        for _ in range(size):
+            value, pos = _decode(buf, pos, base)
+            res.append(value)
+        return res, pos
+    elif type_id == MMDBTypeID.BOOLEAN:
+        return bool(size), pos
+
+    payload = bytes(buf[pos : pos + size])
+    if len(payload) != size:
+        raise ValueError(f"truncated data field at {start}")
+    pos += size
+    if type_id == MMDBTypeID.STRING:
+        return payload.decode("utf-8"), pos
+    elif type_id == MMDBTypeID.BYTES:
+        return payload, pos
+    elif type_id == MMDBTypeID.DOUBLE and size == 8:
+        return struct.unpack(">d", payload)[0], pos
+    elif type_id == MMDBTypeID.FLOAT and size == 4:
+        return struct.unpack(">f", payload)[0], pos
+    elif type_id == MMDBTypeID.INT32 and size <= 4:
+        return int.from_bytes(payload, "big", signed=size == 4), pos
+    elif type_id in _MAX_SIZE and size <= _MAX_SIZE[type_id]:
+        return int.from_bytes(payload, "big"), pos
+    raise ValueError(f"invalid data field of type {type_id} size {size} at {start}")
+
 
 class SearchTreeNode:
+    __slots__ = ("left", "right", "index")
+
     def __init__(self, left=None, right=None):
         self.left = left
         self.right = right
+        # set by a consuming TreeWriter, which owns the tree
+        self.index = None
 
     def get_or_create(self, item):
         if item == 0:
@@ -123,8 +345,13 @@ class SearchTreeNode:
 
 
 class SearchTreeLeaf:
+    # a writer keeps weak references to its leaves, to plan a build cheaply
+    __slots__ = ("value", "offset", "__weakref__")
+
     def __init__(self, value):
         self.value = value
+        # set by a consuming TreeWriter, which owns the tree
+        self.offset = None
 
     def __repr__(self):
         return f"SearchTreeLeaf(value={self.value})"
@@ -157,15 +384,44 @@ FloatType = Union[Literal["f32", "f64", "float32", "float64"], MmdbF32, MmdbF64]
 
 class Encoder:
     def __init__(
-        self, cache=True, int_type: IntType = "auto", float_type: FloatType = "f64"
+        self,
+        cache=True,
+        int_type: IntType = "auto",
+        float_type: FloatType = "f64",
+        spill: Union[bool, str] = False,
+        digest_cache: bool = None,
     ):
+        """
+        Args:
+            cache: Whether to store values in the data section and deduplicate
+                   them, returning pointers. Defaults to True.
+            int_type: The type of integer to use. Defaults to "auto".
+            float_type: The type of float to use. Defaults to "f64".
+            spill: Stream encoded values to a temporary file instead of keeping
+                   them in `data_list`, and deduplicate by a digest of the encoded
+                   bytes instead of a frozen copy of the value. A string is used
+                   as the directory of the temporary file. Defaults to False.
+            digest_cache: Deduplicate by a digest of the encoded bytes, which
+                          needs far less memory than frozen values but encodes
+                          every value before it is looked up. Defaults to `spill`.
+        """
         self.cache = cache
         self.int_type = int_type
         self.float_type = float_type
+        self.spill = bool(spill)
+        self.digest_cache = self.spill if digest_cache is None else digest_cache
 
         self.data_cache = {}
         self.data_list = []
         self.data_pointer = 0
+        self._spill_file = None
+        if self.spill:
+            import tempfile
+
+            self._spill_file = tempfile.TemporaryFile(
+                buffering=SPILL_BUFFER_SIZE,
+                dir=spill if isinstance(spill, str) else None,
+            )
         self._python_type_id = {
             float: MMDBTypeID.DOUBLE,
             bool: MMDBTypeID.BOOLEAN,
@@ -360,8 +616,14 @@ class Encoder:
             return tuple((k, self._freeze(v)) for k, v in value.items())
         elif isinstance(value, list):
             return tuple(self._freeze(v) for v in value)
+        elif isinstance(value, MmdbRaw):
+            return (MmdbRaw, *(self._freeze(p) for p in value.parts))
         return value
 
+    def _encode_raw(self, value):
+        # Nested raw values are where the source had pointers.
+        return b"".join(p if type(p) is bytes else self.encode(p) for p in value.parts)
+
     def encode_meta(self, meta):
         res = self._make_header(MMDBTypeID.MAP, len(meta))
         meta_type = {
@@ -378,8 +640,64 @@ class Encoder:
             res += self.encode(v, meta_type.get(k))
         return res
 
+    def _store(self, res):
+        if self._spill_file is None:
+            self.data_list.append(res)
+        else:
+            self._spill_file.write(res)
+        offset = self.data_pointer
+        self.data_pointer += len(res)
+        return offset
+
+    def write_data(self, f, consume=False, size=None):
+        """
+        Writes all stored values (the data section) to the file object `f`.
+
+        With `consume=True` every in-memory value is released once it is written.
+        With `size`, only the values in the first `size` bytes are written.
+        """
+        for _ in self.iter_write_data(f, consume, size):
+            pass
+
+    def iter_write_data(self, f, consume=False, size=None):
+        """Like :meth:`write_data`, but yields after about every megabyte."""
+        if self._spill_file is None:
+            elements = _pop_all(self.data_list) if consume else self.data_list
+            pending = 0
+            for element in elements:
+                if size is not None:
+                    if size <= 0:
+                        break
+                    size -= len(element)
+                f.write(element)
+                pending += len(element)
+                if pending >= SPILL_BUFFER_SIZE:
+                    pending = 0
+                    yield
+        else:
+            self._spill_file.flush()
+            self._spill_file.seek(0)
+            try:
+                while size is None or size > 0:
+                    length = SPILL_BUFFER_SIZE
+                    if size is not None:
+                        length = min(size, length)
+                        size -= length
+                    buf = self._spill_file.read(length)
+                    if not buf:
+                        break
+                    f.write(buf)
+                    yield
+            finally:
+                self._spill_file.seek(0, os.SEEK_END)
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
     def encode(self, value, type_id=None, return_offset=False):
-        if self.cache:
+        if self.cache and not self.digest_cache:
             cache_key = self._freeze(value)
             try:
                 offset = self.data_cache[cache_key]
@@ -387,27 +705,79 @@ class Encoder:
             except KeyError:
                 pass
 
-        if not type_id:
-            type_id = self.python_type_id(value)
+        if isinstance(value, MmdbRaw):
+            res = self._encode_raw(value)
+        else:
+            if not type_id:
+                type_id = self.python_type_id(value)
 
-        try:
-            encoder = self.type_encoder[type_id]
-        except KeyError as err:
-            raise ValueError(f"unknown type_id={type_id}") from err
+            try:
+                encoder = self.type_encoder[type_id]
+            except KeyError as err:
+                raise ValueError(f"unknown type_id={type_id}") from err
 
-        if isinstance(value, MmdbBaseType):
-            value = value.value
-        res = encoder(value)
+            if isinstance(value, MmdbBaseType):
+                value = value.value
+            res = encoder(value)
 
         if self.cache:
-            self.data_list.append(res)
-            offset = self.data_pointer
-            self.data_pointer += len(res)
+            if self.digest_cache:
+                # The value has to be encoded before it can be looked up, but only
+                # a 16 byte digest is kept for every distinct value.
+                cache_key = hashlib.blake2b(res, digest_size=16).digest()
+                offset = self.data_cache.get(cache_key)
+                if offset is not None:
+                    return offset if return_offset else self._encode_pointer(offset)
+            offset = self._store(res)
             self.data_cache[cache_key] = offset
             return offset if return_offset else self._encode_pointer(offset)
         return res
 
 
+def _pop_all(items):
+    """Yields the items of a list in order, removing each one from the list."""
+    items.reverse()
+    while items:
+        yield items.pop()
+
+
+class _SizingEncoder(Encoder):
+    """Encoder that only measures the data section instead of storing it."""
+
+    def _store(self, res):
+        offset = self.data_pointer
+        self.data_pointer += len(res)
+        return offset
+
+
+def _record_size_for(node_count, data_pointer, min_record_size=24):
+    # Tree records should be large enough to contain either tree node index
+    # or data offset.
+    max_id = node_count + data_pointer + 1
+
+    # Estimate required bit count.
+    bit_count = int(math.ceil(math.log(max_id, 2)))
+    bit_count = max(bit_count, min_record_size)
+    if bit_count <= 24:
+        return 24
+    elif bit_count <= 28:
+        return 28
+    elif bit_count <= 32:
+        return 32
+    else:
+        raise Exception("record_size > 32")
+
+
+class BuildPlan(NamedTuple):
+    """The sizes a database would be written with, see :meth:`MMDBWriter.plan`."""
+
+    node_count: int
+    leaf_count: int
+    data_size: int
+    record_size: int
+    file_size: int
+
+
 class TreeWriter:
     encoder_cls = Encoder
 
@@ -417,19 +787,48 @@ class TreeWriter:
         meta: dict,
         int_type: IntType = "auto",
         float_type: FloatType = "f64",
+        spill: Union[bool, str] = False,
+        consume: bool = False,
+        encoder: "Encoder" = None,
+        weights: dict = None,
+        record_size: int = None,
     ):
+        if record_size not in (None, 24, 28, 32):
+            raise ValueError(
+                f"record_size should be 24, 28 or 32, {record_size} is incorrect"
+            )
         self._node_idx = {}
         self._leaf_offset = {}
         self._node_list = []
         self._node_counter = 0
-        self._record_size = 0
+        # the smallest record size to use, a larger tree may need a larger one
+        self._min_record_size = record_size or 24
+        # nodes reachable through more than one parent
+        self._shared_nodes = set()
 
         self.tree = tree
         self.meta = meta
-
-        self.encoder = self.encoder_cls(
-            cache=True, int_type=int_type, float_type=float_type
-        )
+        self.consume = consume
+        # {(network int, prefix length): weight} of the lookups to lay out first
+        self.weights = weights
+        # Without a hot layout, a consuming writer numbers the nodes and leaves on
+        # themselves and writes them in the same depth-first order, so it needs no
+        # index of the whole tree.
+        self._number_in_tree = consume and not weights
+        self._prepared = False
+        self._data_size = None
+
+        # A shared encoder is owned, and closed, by the caller.
+        self._own_encoder = encoder is None
+        if encoder is None:
+            encoder = self.encoder_cls(
+                cache=True,
+                int_type=int_type,
+                float_type=float_type,
+                spill=spill,
+                digest_cache=True if consume else None,
+            )
+        self.encoder = encoder
 
     @property
     def _data_list(self):
@@ -437,6 +836,8 @@ class TreeWriter:
 
     @property
     def _data_pointer(self):
+        if self._data_size is not None:
+            return self._data_size + 16
         return self.encoder.data_pointer + 16
 
     def _build_meta(self):
@@ -447,21 +848,9 @@ class TreeWriter:
         }
 
     def _adjust_record_size(self):
-        # Tree records should be large enough to contain either tree node index
-        # or data offset.
-        max_id = self._node_counter + self._data_pointer + 1
-
-        # Estimate required bit count.
-        bit_count = int(math.ceil(math.log(max_id, 2)))
-        if bit_count <= 24:
-            self.record_size = 24
-        elif bit_count <= 28:
-            self.record_size = 28
-        elif bit_count <= 32:
-            self.record_size = 32
-        else:
-            raise Exception("record_size > 32")
-
+        self.record_size = _record_size_for(
+            self._node_counter, self._data_pointer, self._min_record_size
+        )
         self.data_offset = self.record_size * 2 / 8 * self._node_counter
 
     def _enumerate_nodes(self, node):
@@ -471,6 +860,8 @@ class TreeWriter:
                 self._node_idx[node_id] = self._node_counter
                 self._node_counter += 1
                 self._node_list.append(node)
+            else:
+                self._shared_nodes.add(node_id)
 
             self._enumerate_nodes(node.left)
             self._enumerate_nodes(node.right)
@@ -480,15 +871,38 @@ class TreeWriter:
             if node_id not in self._leaf_offset:
                 offset = self.encoder.encode(node.value, return_offset=True)
                 self._leaf_offset[node_id] = offset + 16
+                if self.consume:
+                    node.value = None
         else:  # == None
             return
 
+    def _number_tree(self):
+        # Same order as _enumerate_nodes, with the numbers stored in the tree.
+        stack = [self.tree]
+        while stack:
+            node = stack.pop()
+            if type(node) is SearchTreeNode:
+                if node.index is None:
+                    node.index = self._node_counter
+                    self._node_counter += 1
+                    stack.append(node.right)
+                    stack.append(node.left)
+            elif type(node) is SearchTreeLeaf:
+                if node.offset is None:
+                    offset = self.encoder.encode(node.value, return_offset=True)
+                    node.offset = offset + 16
+                    node.value = None
+
     def _calc_record_idx(self, node):
         if node is None:
             return self._node_counter
         elif type(node) is SearchTreeNode:
+            if self._number_in_tree:
+                return node.index
             return self._node_idx[id(node)]
         elif type(node) is SearchTreeLeaf:
+            if self._number_in_tree:
+                return node.offset + self._node_counter
             return self._leaf_offset[id(node)] + self._node_counter
         else:
             raise Exception("unexpected type")
@@ -522,21 +936,528 @@ class TreeWriter:
         else:
             raise Exception("self.record_size > 32")
 
-    def write(self, fname):
-        self._enumerate_nodes(self.tree)
+    def _write_nodes(self, f):
+        if self._number_in_tree:
+            yield from self._write_tree(f)
+            return
+        if not self.consume:
+            for index, node in enumerate(self._node_list, 1):
+                f.write(self._cal_node_bytes(node))
+                if index % WRITE_CHUNK_NODES == 0:
+                    yield
+            return
+
+        # Release every node as soon as its record is written. A parent is always
+        # written before its children, so only shared nodes are still looked up
+        # after that.
+        self.tree = None
+        node_list = self._node_list
+        for index in range(len(node_list)):
+            node = node_list[index]
+            node_list[index] = None
+            f.write(self._cal_node_bytes(node))
+            node_id = id(node)
+            if node_id not in self._shared_nodes:
+                del self._node_idx[node_id]
+            if (index + 1) % WRITE_CHUNK_NODES == 0:
+                node = None
+                yield
+        node = None
+        self._node_list = []
+        self._node_idx = {}
+        self._leaf_offset = {}
+        self._shared_nodes = set()
+
+    def _write_tree(self, f):
+        # Walks the tree in numbering order and unlinks every written node from
+        # its children, so nodes and leaves are freed as soon as the last record
+        # pointing to them is written.
+        stack = [self.tree]
+        self.tree = None
+        written = 0
+        while stack:
+            node = stack.pop()
+            if node.index < written:
+                continue  # a shared node, written through another parent
+            f.write(self._cal_node_bytes(node))
+            written += 1
+            if type(node.right) is SearchTreeNode:
+                stack.append(node.right)
+            if type(node.left) is SearchTreeNode:
+                stack.append(node.left)
+            node.left = node.right = None
+            if written % WRITE_CHUNK_NODES == 0:
+                node = None
+                yield
+
+    def _hot_entries(self):
+        """Sums the weights of the lookups passing through every node and leaf."""
+        bit_length = 128 if self.meta.get("ip_version") == 6 else 32
+        hot = {}
+        for (prefix, prefixlen), weight in self.weights.items():
+            node = self.tree
+            for i in range(bit_length - 1, bit_length - 1 - prefixlen, -1):
+                if type(node) is not SearchTreeNode:
+                    break
+                _add_weight(hot, node, weight)
+                node = node[(prefix >> i) & 1]
+            # everything below a network is as hot as the network itself
+            stack = [node]
+            while stack:
+                node = stack.pop()
+                if node is None:
+                    continue
+                _add_weight(hot, node, weight)
+                if type(node) is SearchTreeNode:
+                    stack.append(node.right)
+                    stack.append(node.left)
+        return hot
+
+    def _order_hot_nodes(self, hot):
+        # The root stays node 0. Otherwise the hottest nodes come first, and ties
+        # keep the depth-first order, so a parent still precedes its children.
+        hot_nodes = [obj for _, obj in hot if type(obj) is SearchTreeNode]
+        weight = {id(obj): w for w, obj in hot}
+        hot_nodes.sort(
+            key=lambda n: (
+                n is not self.tree,
+                -weight[id(n)],
+                self._node_idx[id(n)],
+            )
+        )
+        hot_ids = {id(node) for node in hot_nodes}
+        self._node_list = hot_nodes + [
+            node for node in self._node_list if id(node) not in hot_ids
+        ]
+        self._node_idx = {id(node): idx for idx, node in enumerate(self._node_list)}
+
+    def prepare(self):
+        """
+        Numbers the nodes and encodes the values of the tree.
+
+        Values already stored in a shared encoder are reused. The data section of
+        this tree is the encoder content at the time of preparing, so an encoder
+        can be shared by several trees as long as each one is prepared before the
+        next one adds values.
+        """
+        if self._prepared:
+            return
+        if self.weights:
+            hot = sorted(self._hot_entries().values(), key=lambda e: -e[0])
+            for _, obj in hot:
+                if type(obj) is SearchTreeLeaf:
+                    self._enumerate_nodes(obj)
+            self._enumerate_nodes(self.tree)
+            self._order_hot_nodes(hot)
+        elif self._number_in_tree:
+            self._number_tree()
+        else:
+            self._enumerate_nodes(self.tree)
+        if self.consume:
+            # nothing is encoded after this
+            self.encoder.data_cache = {}
+        self._data_size = self.encoder.data_pointer
         self._adjust_record_size()
+        self._prepared = True
 
-        with open(fname, "wb") as f:
-            for node in self._node_list:
-                f.write(self._cal_node_bytes(node))
+    def write(self, fname, compression=None, compresslevel=None, checksum=None):
+        """
+        Writes the database to `fname`.
+
+        Args:
+           fname: The path of the output file.
+           compression: Compress the output while writing it, "gzip", "bz2" or
+                        "xz". Defaults to None.
+           compresslevel: The compression level (the preset for "xz"). Defaults
+                          to the level of the compression module.
+           checksum: A hashlib algorithm, e.g. "sha256". The digest of the written
+                     file is stored in "<fname>.<checksum>" in the format of
+                     sha256sum. Defaults to None.
+        """
+        for _ in self.iter_write(fname, compression, compresslevel, checksum):
+            pass
 
-            f.write(b"\x00" * 16)
+    def iter_write(self, fname, compression=None, compresslevel=None, checksum=None):
+        """
+        Like :meth:`write`, but a generator that yields after preparing the tree
+        and after every chunk of nodes or data written, so the write can be
+        interleaved with other work or abandoned by closing the generator.
+        """
+        self.prepare()
+        yield
+        digest = hashlib.new(checksum) if checksum else None
 
-            for element in self._data_list:
-                f.write(element)
+        try:
+            with _open_output(fname, compression, compresslevel, digest) as f:
+                yield from self._write_nodes(f)
+
+                f.write(b"\x00" * 16)
+
+                if self._own_encoder:
+                    yield from self.encoder.iter_write_data(f, consume=self.consume)
+                else:
+                    yield from self.encoder.iter_write_data(f, size=self._data_size)
+
+                self.metadata_start = f.tell()
+                f.write(METADATA_MAGIC)
+                f.write(self.encoder_cls(cache=False).encode_meta(self._build_meta()))
+        finally:
+            if self._own_encoder:
+                self.encoder.close()
+        if digest is not None:
+            _write_checksum(fname, checksum, digest.hexdigest())
+
+
+def _add_weight(hot, obj, weight):
+    entry = hot.get(id(obj))
+    if entry is None:
+        hot[id(obj)] = [weight, obj]
+    else:
+        entry[0] += weight
+
+
+def _traffic_weights(traffic, bit_length):
+    """
+    Sums a traffic sample into {(network int, prefix length): weight}.
+
+    Every item is an address or network (an ipaddress or netaddr object, a string
+    or an int address), or a pair of one of those and its weight. IPv4 items are
+    mapped to ::/96 of an IPv6 tree, IPv6 items are ignored by an IPv4 tree.
+    """
+    weights = {}
+    for item in traffic:
+        weight = 1
+        if type(item) is tuple:
+            item, weight = item
+        key = _network_key(item, bit_length)
+        if key is not None:
+            weights[key] = weights.get(key, 0) + weight
+    return weights
+
+
+def _network_key(item, bit_length):
+    """
+    Returns the (network int, prefix length) of an address or network in a tree of
+    `bit_length`, or None for an IPv6 network and an IPv4 tree.
+    """
+    if type(item) is int:
+        return item, bit_length
+    network = ipaddress.ip_network(str(item), strict=False)
+    if network.max_prefixlen > bit_length:
+        return None
+    return (
+        int(network.network_address),
+        network.prefixlen + bit_length - network.max_prefixlen,
+    )
+
+
+def _shard_networks(spec, bit_length):
+    """
+    Normalizes the networks of a shard to sorted, disjoint (network int, prefix
+    length) pairs.
+    """
+    if hasattr(spec, "iter_cidrs"):
+        spec = spec.iter_cidrs()
+    networks = []
+    for item in spec:
+        if type(item) is tuple:
+            first, last = item
+            while first <= last:
+                # the largest aligned block starting at `first` inside the range
+                size = (first & -first).bit_length() - 1 if first else bit_length
+                while first + (1 << size) - 1 > last:
+                    size -= 1
+                networks.append((first, bit_length - size))
+                first += 1 << size
+        else:
+            key = _network_key(item, bit_length)
+            if key is not None:
+                networks.append(key)
+    networks.sort()
+    res = []
+    for network, prefixlen in networks:
+        if res:
+            outer, outer_len = res[-1]
+            if (
+                prefixlen >= outer_len
+                and (network ^ outer) >> bit_length - outer_len == 0
+            ):
+                continue
+        res.append((network, prefixlen))
+    return res
+
+
+def _prune_tree(tree, networks, bit_length):
+    """
+    Returns a tree of the parts of `tree` inside `networks`, see _shard_networks.
+
+    Subtrees fully inside a network are shared with `tree`, not copied.
+    """
+
+    def prune(node, prefix, depth, lo, hi):
+        # networks[lo:hi] are the networks inside this node
+        if node is None or lo == hi:
+            return None
+        if networks[lo][1] == depth:
+            return node
+        if type(node) is SearchTreeLeaf:
+            left = right = node
+        else:
+            left, right = node.left, node.right
+        middle = prefix | 1 << bit_length - depth - 1
+        split = bisect.bisect_left(networks, (middle, 0), lo, hi)
+        left = prune(left, prefix, depth + 1, lo, split)
+        right = prune(right, middle, depth + 1, split, hi)
+        if left is None and right is None:
+            return None
+        return SearchTreeNode(left, right)
+
+    return prune(tree, 0, 0, 0, len(networks)) or SearchTreeNode()
+
+
+def _scan_tree(tree):
+    """
+    Returns the ids of the nodes of `tree` that have more than one parent, the
+    number of distinct nodes and the distinct leaves.
+    """
+    seen = set()
+    shared = set()
+    leaves = {}
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if type(node) is SearchTreeLeaf:
+            leaves[id(node)] = node
+            continue
+        if type(node) is not SearchTreeNode:
+            continue
+        if id(node) in seen:
+            shared.add(id(node))
+            continue
+        seen.add(id(node))
+        stack.append(node.right)
+        stack.append(node.left)
+    return shared, len(seen), list(leaves.values())
+
+
+def _count_nodes(node, shared):
+    """Returns the number of nodes that are only reachable through `node`."""
+    count = 0
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if type(node) is SearchTreeNode and id(node) not in shared:
+            count += 1
+            stack.append(node.left)
+            stack.append(node.right)
+    return count
+
+
+class _HashingWriter:
+    """Writes through to `f`, hashing everything that is written."""
+
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+
+    def write(self, b):
+        self.digest.update(b)
+        return self.f.write(b)
+
+    def tell(self):
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+
+def _gzip_writer(f, level):
+    import gzip
+
+    # a fixed mtime and no file name in the header keep the output reproducible
+    if level is None:
+        return gzip.GzipFile(filename="", fileobj=f, mode="wb", mtime=0)
+    return gzip.GzipFile(
+        filename="", fileobj=f, mode="wb", compresslevel=level, mtime=0
+    )
+
+
+def _bz2_writer(f, level):
+    import bz2
+
+    if level is None:
+        return bz2.BZ2File(f, "wb")
+    return bz2.BZ2File(f, "wb", compresslevel=level)
+
+
+def _xz_writer(f, level):
+    import lzma
+
+    return lzma.LZMAFile(f, "wb", preset=level)
+
+
+_COMPRESSORS = {
+    "gzip": _gzip_writer,
+    "bz2": _bz2_writer,
+    "xz": _xz_writer,
+}
+
+
+@contextlib.contextmanager
+def _open_output(fname, compression=None, compresslevel=None, digest=None):
+    if compression is not None and compression not in _COMPRESSORS:
+        raise ValueError(f"unknown compression={compression}")
+    with open(fname, "wb") as f:
+        if digest is not None:
+            f = _HashingWriter(f, digest)
+        if compression is None:
+            yield f
+        else:
+            with _COMPRESSORS[compression](f, compresslevel) as cf:
+                yield cf
+
+
+def _write_checksum(fname, algorithm, hexdigest):
+    with open(f"{fname}.{algorithm}", "w") as f:
+        f.write(f"{hexdigest}  {os.path.basename(fname)}\n")
+
+
+def _file_digest(fname, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(fname, "rb") as f:
+        for buf in iter(lambda: f.read(SPILL_BUFFER_SIZE), b""):
+            digest.update(buf)
+    return digest.hexdigest()
+
+
+def _state_key(value):
+    # Like Encoder._freeze, but type-strict so that e.g. True and 1 stay distinct.
+    if isinstance(value, dict):
+        return dict, tuple((k, _state_key(v)) for k, v in value.items())
+    elif isinstance(value, list):
+        return list, tuple(_state_key(v) for v in value)
+    elif isinstance(value, MmdbRaw):
+        return MmdbRaw, tuple(_state_key(p) for p in value.parts)
+    elif isinstance(value, MmdbBaseType):
+        return type(value), _state_key(value.value)
+    return type(value), value
+
+
+def _native_uint32(buf):
+    """View little-endian uint32 data as a sequence, without copying if possible."""
+    if sys.byteorder == "little":
+        return buf.cast("I")
+    res = array("I")
+    res.frombytes(buf)
+    res.byteswap()
+    return res
+
+
+def _ip_network(prefix, prefixlen, bit_length):
+    if bit_length == 32:
+        return ipaddress.IPv4Network((prefix, prefixlen))
+    return ipaddress.IPv6Network((prefix, prefixlen))
+
+
+class OverlapCollector:
+    """
+    Collects the overlaps found by :meth:`MMDBWriter.insert_network`.
+
+    Every overlap is recorded as a compact ``(prefix, prefixlen, old_value,
+    new_value)`` tuple in `records`, where `prefix` is the integer address of the
+    existing network that was overwritten or split. A network inserted over
+    smaller ones records each of them. Readable networks are only built when
+    iterating over the collector.
+    """
+
+    def __init__(self, bit_length=32):
+        self.bit_length = bit_length
+        self.records = []
+
+    def add(self, prefix, prefixlen, old_value, new_value):
+        self.records.append((prefix, prefixlen, old_value, new_value))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        """Yields ``(network, old_value, new_value)`` for every overlap."""
+        for prefix, prefixlen, old_value, new_value in self.records:
+            network = _ip_network(prefix, prefixlen, self.bit_length)
+            yield network, old_value, new_value
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _buildinfo_path(filename):
+    return f"{filename}.buildinfo"
+
+
+def _write_buildinfo(filename, info):
+    import json
+
+    info = {**info, "size": os.path.getsize(filename)}
+    with open(_buildinfo_path(filename), "w") as f:
+        json.dump(info, f)
 
-            f.write(METADATA_MAGIC)
-            f.write(self.encoder_cls(cache=False).encode_meta(self._build_meta()))
+
+class _Cidr(NamedTuple):
+    value: int
+    prefixlen: int
+    version: int
+
+    def __str__(self):
+        return str(
+            _ip_network(self.value, self.prefixlen, 128 if self.version == 6 else 32)
+        )
+
+
+Network = Union[
+    "IPSet",
+    ipaddress.IPv4Network,
+    ipaddress.IPv6Network,
+    ipaddress.IPv4Address,
+    ipaddress.IPv6Address,
+    str,
+    list,
+]
+
+
+def _iter_cidrs(network, ip_version):
+    """Yields a _Cidr for every network of an insert_network argument."""
+    if hasattr(network, "iter_cidrs"):  # netaddr.IPSet
+        for cidr in network.iter_cidrs():
+            yield _Cidr(cidr.value, cidr.prefixlen, cidr.version)
+        return
+    if (
+        type(network) is tuple
+        and len(network) == 2
+        and all(type(part) is int for part in network)
+    ):
+        # a single (network int, prefix length)
+        network = [network]
+    elif not isinstance(network, (list, tuple, set, frozenset)):
+        network = [network]
+    for item in network:
+        if type(item) is tuple:
+            value, prefixlen = item
+            bit_length = 128 if ip_version == 6 else 32
+            if not 0 <= value < 1 << bit_length:
+                raise ValueError(f"{value} is not an IPv{ip_version} network address")
+            if not 0 <= prefixlen <= bit_length:
+                raise ValueError(
+                    f"{prefixlen} is not a valid IPv{ip_version} prefix length"
+                )
+            yield _Cidr(value, prefixlen, ip_version)
+            continue
+        if not isinstance(item, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            item = ipaddress.ip_network(str(item), strict=False)
+        yield _Cidr(int(item.network_address), item.prefixlen, item.version)
 
 
 def bits_rstrip(n, length=None, keep=0):
@@ -553,6 +1474,11 @@ class MMDBWriter:
         ipv4_compatible=False,
         int_type: IntType = "auto",
         float_type: FloatType = "f64",
+        collect_overlaps: bool = False,
+        thread_safe: bool = False,
+        lock_stripe_bits: int = 8,
+        build_cache: bool = False,
+        cache_epoch: Literal["keep", "refresh"] = "keep",
     ):
         """
         Args:
@@ -563,6 +1489,28 @@ class MMDBWriter:
             ipv4_compatible: Whether the database is compatible with IPv4.
             int_type: The type of integer to use. Defaults to "auto".
             float_type: The type of float to use. Defaults to "f64".
+            collect_overlaps: Record overlapping inserts in `self.overlaps` (an
+                              OverlapCollector) instead of logging them.
+                              Defaults to False.
+            thread_safe: Allow calling insert_network from several threads at
+                         once. Defaults to False.
+            lock_stripe_bits: With thread_safe=True, the address space is split
+                              into 2 ** lock_stripe_bits stripes by the leading
+                              address bits, inserts into different stripes run in
+                              parallel. With ipv4_compatible=True, IPv4 networks
+                              are striped by their own leading bits instead.
+                              Defaults to 8.
+            build_cache: Fingerprint the inserted networks, values and options,
+                         and skip to_db_file when the output file was already
+                         written from the same fingerprint. The fingerprint is
+                         kept next to the output in "<filename>.buildinfo".
+                         With thread_safe=True the order of inserts is not
+                         fingerprinted, as it is not deterministic, so builds
+                         that only differ in the order of overlapping inserts
+                         share a fingerprint. Defaults to False.
+            cache_epoch: What to do with the build_epoch of a reused file, "keep"
+                         leaves the file untouched, "refresh" rewrites its
+                         metadata with the current time. Defaults to "keep".
 
         Note:
             If you want to store an IPv4 address in an IPv6 database, you should set
@@ -571,6 +1519,8 @@ class MMDBWriter:
             If you want to use a specific integer type, you can set int_type to
             "u16", "u32", "u64", "u128", or "i32".
         """
+        import threading
+
         self.tree = SearchTreeNode()
         self.ipv4_compatible = ipv4_compatible
 
@@ -601,20 +1551,61 @@ class MMDBWriter:
 
         self.int_type = int_type
         self.float_type = float_type
+        self.overlaps = OverlapCollector(self._bit_length) if collect_overlaps else None
+        # ids of nodes with several parents, like the IPv4 aliases of a merged or
+        # loaded IPv6 tree, which are copied before an insert changes them
+        self._shared_nodes = set()
+        # Kept during inserts for a cheap plan: the number of nodes in the tree,
+        # and weak references to its leaves, which drop out once overwritten.
+        self._node_count = 1
+        self._leaves = weakref.WeakSet()
+        self._plan_lock = threading.Lock()
+
+        self._stripe_bits = lock_stripe_bits
+        self._stripe_locks = None
+        self._ipv4_stripe_locks = None
+        self._tree_lock = None
+        if thread_safe:
+            if not 0 < lock_stripe_bits < self._bit_length:
+                raise ValueError(
+                    f"lock_stripe_bits should be in range(1, {self._bit_length})"
+                )
+            self._tree_lock = threading.Lock()
+            self._stripe_locks = [
+                threading.Lock() for _ in range(1 << lock_stripe_bits)
+            ]
+            if ipv4_compatible and lock_stripe_bits < 32:
+                # all of IPv4 is in ::/96, which would be a single stripe
+                self._ipv4_stripe_locks = [
+                    threading.Lock() for _ in range(1 << lock_stripe_bits)
+                ]
+
+        if cache_epoch not in ("keep", "refresh"):
+            raise ValueError(f"unknown cache_epoch={cache_epoch}")
+        self.cache_epoch = cache_epoch
+        self._fingerprint = hashlib.sha256() if build_cache else None
+        self._fingerprint_lock = threading.Lock()
+        # sum of the insert digests of a thread-safe writer, modulo 2 ** 256
+        self._insert_digest_sum = 0
+        self._fingerprint_encoder = Encoder(
+            cache=False, int_type=int_type, float_type=float_type
+        )
 
-    def insert_network(self, network: IPSet, content: MMDBType):
+    def insert_network(self, network: "Network", content: MMDBType):
         """
         Inserts a network into the MaxMind database.
 
         Args:
-           network: The network to be inserted. It should be an instance of
-                    netaddr.IPSet.
+           network: The network to be inserted: a netaddr.IPSet, an ipaddress
+                    network or address, a string like "1.0.0.0/8", a (network
+                    int, prefix length) tuple in the address space of this
+                    database, or a list of those.
            content: The content associated with the network. It can be a
                     dictionary, list, string, bytes, integer, or boolean.
 
 
         Raises:
-           ValueError: If the network is not an instance of netaddr.IPSet.
+           ValueError: If the network can't be parsed.
            ValueError: If an IPv6 address is inserted into an IPv4-only database.
            ValueError: If an IPv4 address is inserted into an IPv6 database without
                        setting ipv4_compatible=True.
@@ -623,10 +1614,13 @@ class MMDBWriter:
            This method modifies the internal tree structure of the MMDBWriter instance.
         """
         leaf = SearchTreeLeaf(content)
-        if not isinstance(network, IPSet):
-            raise ValueError("network type should be netaddr.IPSet.")
-        network = network.iter_cidrs()
-        for cidr in network:
+        if self._stripe_locks is None:
+            self._leaves.add(leaf)
+        else:
+            with self._plan_lock:
+                self._leaves.add(leaf)
+        fingerprint = hashlib.sha256() if self._fingerprint is not None else None
+        for cidr in _iter_cidrs(network, self.ip_version):
             if self.ip_version == 4 and cidr.version == 6:
                 raise ValueError(
                     f"You inserted a IPv6 address {cidr} to an IPv4-only database."
@@ -638,54 +1632,1529 @@ class MMDBWriter:
                         "Please use ipv4_compatible=True option store "
                         "IPv4 address in IPv6 database as ::/96 format"
                     )
-                cidr = cidr.ipv6(True)
-            node = self.tree
-            bits = list(bits_rstrip(cidr.value, self._bit_length, cidr.prefixlen))
-            current_node = node
-            supernet_leaf = None  # Tracks whether we are inserting into a subnet
-            for index, ip_bit in enumerate(bits[:-1]):
-                previous_node = current_node
-                current_node = previous_node.get_or_create(ip_bit)
-
-                if isinstance(current_node, SearchTreeLeaf):
-                    current_cidr = IPNetwork(
-                        (
-                            int(
-                                "".join(map(str, bits[: index + 1])).ljust(
-                                    self._bit_length, "0"
-                                ),
-                                2,
-                            ),
-                            index + 1,
-                        )
+                # IPv4 networks live in ::/96
+                cidr = _Cidr(cidr.value, cidr.prefixlen + 96, 6)
+            parts = [cidr]
+            if cidr.prefixlen == 0:
+                # the root is always a node, so a /0 is inserted as both halves
+                half = 1 << self._bit_length - 1
+                parts = [_Cidr(0, 1, cidr.version), _Cidr(half, 1, cidr.version)]
+            for cidr in parts:
+                created = self._insert_cidr(cidr, leaf, content)
+                if self._stripe_locks is None:
+                    self._node_count += created
+                else:
+                    with self._plan_lock:
+                        self._node_count += created
+                if fingerprint is not None:
+                    fingerprint.update(cidr.value.to_bytes(16, "big"))
+                    fingerprint.update(bytes([cidr.prefixlen]))
+
+        if fingerprint is not None:
+            fingerprint.update(self._fingerprint_encoder.encode(content))
+            # Inserts are hashed in call order, as overlapping inserts depend on it,
+            # unless they run in parallel and have no order.
+            with self._fingerprint_lock:
+                if self._stripe_locks is None:
+                    self._fingerprint.update(fingerprint.digest())
+                else:
+                    digest = int.from_bytes(fingerprint.digest(), "big")
+                    self._insert_digest_sum = (self._insert_digest_sum + digest) % (
+                        1 << 256
                     )
+
+    def _insert_cidr(self, cidr, leaf, content):
+        # returns the change in the number of nodes
+        bits = list(bits_rstrip(cidr.value, self._bit_length, cidr.prefixlen))
+        if self._stripe_locks is None:
+            return self._insert_bits(cidr, bits, leaf, content)
+
+        # Locks are always taken in the same order: stripes ascending, then IPv4
+        # stripes ascending, then the tree lock. Networks shorter than the stripe
+        # prefix take every stripe they cover and hold the tree lock for the whole
+        # insert. Longer ones release the tree lock once they reach their own
+        # stripe. IPv4 networks in an IPv6 tree are striped below ::/96, and hold
+        # the first IPv6 stripe until they reach their IPv4 stripe.
+        root = 0
+        stripe_locks = self._stripe_locks
+        if (
+            self._ipv4_stripe_locks is not None
+            and cidr.prefixlen > 96
+            and cidr.value >> 32 == 0
+        ):
+            root = 96
+            stripe_locks = self._ipv4_stripe_locks
+        host_bits = self._bit_length - root - self._stripe_bits
+        first = (cidr.value >> host_bits) & ((1 << self._stripe_bits) - 1)
+        if cidr.prefixlen - root <= self._stripe_bits:
+            count = 1 << (self._stripe_bits - cidr.prefixlen + root)
+            stripes = stripe_locks[first : first + count]
+        else:
+            stripes = [stripe_locks[first]]
+        if root:
+            stripes = [self._stripe_locks[0], *stripes]
+        elif (
+            self._ipv4_stripe_locks is not None
+            and cidr.prefixlen <= 96
+            and cidr.value >> (128 - cidr.prefixlen) == 0
+        ):
+            # covers ::/96
+            stripes = [*stripes, *self._ipv4_stripe_locks]
+        for lock in stripes:
+            lock.acquire()
+        try:
+            self._tree_lock.acquire()
+            # (depth to release at, lock), the last one is released first
+            held = [(self._stripe_bits - 1, self._tree_lock)]
+            if root:
+                held.insert(0, (root + self._stripe_bits - 1, stripes.pop(0)))
+            if self._shared_nodes:
+                # a shared subtree is reachable from several stripes
+                held = [(self._bit_length, lock) for _, lock in held]
+            try:
+                return self._insert_bits(cidr, bits, leaf, content, held)
+            finally:
+                for _, lock in held:
+                    lock.release()
+        finally:
+            for lock in stripes:
+                lock.release()
+
+    def _insert_bits(self, cidr, bits, leaf, content, held=None):
+        node = self.tree
+        current_node = node
+        supernet_leaf = None  # Tracks whether we are inserting into a subnet
+        created = 0
+        for index, ip_bit in enumerate(bits[:-1]):
+            while held and index == held[-1][0]:
+                # everything below this point is locked by our stripe
+                held.pop()[1].release()
+            previous_node = current_node
+            current_node = previous_node.right if ip_bit else previous_node.left
+            if current_node is None:
+                current_node = SearchTreeNode()
+                previous_node[ip_bit] = current_node
+                created += 1
+            elif self._shared_nodes and id(current_node) in self._shared_nodes:
+                current_node = self._unshare(previous_node, ip_bit, current_node)
+                created += 1
+
+            if isinstance(current_node, SearchTreeLeaf):
+                host_bits = self._bit_length - index - 1
+                prefix = cidr.value >> host_bits << host_bits
+                if self.overlaps is not None:
+                    self.overlaps.add(prefix, index + 1, current_node.value, leaf.value)
+                elif logger.isEnabledFor(logging.INFO):
                     logger.info(
-                        f"Inserting {cidr} ({content}) into subnet of "
-                        f"{current_cidr} ({current_node.value})"
+                        "Inserting %s (%s) into subnet of %s (%s)",
+                        _ip_network(cidr.value, cidr.prefixlen, self._bit_length),
+                        content,
+                        _ip_network(prefix, index + 1, self._bit_length),
+                        current_node.value,
                     )
-                    supernet_leaf = current_node
-                    current_node = SearchTreeNode()
-                    previous_node[ip_bit] = current_node
-
-                if supernet_leaf:
-                    next_bit = bits[index + 1]
-                    # Insert supernet information on each inverse bit of
-                    # the current subnet
-                    current_node[1 - next_bit] = supernet_leaf
-            current_node[bits[-1]] = leaf
-
-    def to_db_file(self, filename: str):
-        return TreeWriter(
-            self.tree, self._build_meta(), self.int_type, self.float_type
-        ).write(filename)
+                supernet_leaf = current_node
+                current_node = SearchTreeNode()
+                previous_node[ip_bit] = current_node
+                created += 1
+
+            if supernet_leaf:
+                next_bit = bits[index + 1]
+                # Insert supernet information on each inverse bit of
+                # the current subnet
+                current_node[1 - next_bit] = supernet_leaf
+        replaced = current_node[bits[-1]]
+        if self.overlaps is not None and replaced is not None:
+            host_bits = self._bit_length - cidr.prefixlen
+            prefix = cidr.value >> host_bits << host_bits
+            self._collect_replaced(prefix, cidr.prefixlen, replaced, leaf)
+        current_node[bits[-1]] = leaf
+        if type(replaced) is SearchTreeNode:
+            created -= _count_nodes(replaced, self._shared_nodes)
+        return created
+
+    def _collect_replaced(self, prefix, prefixlen, node, leaf):
+        # every network in the subtree, in address order
+        stack = [(node, prefix, prefixlen)]
+        while stack:
+            node, prefix, prefixlen = stack.pop()
+            if type(node) is SearchTreeLeaf:
+                self.overlaps.add(prefix, prefixlen, node.value, leaf.value)
+            elif node is not None:
+                right = prefix | 1 << self._bit_length - prefixlen - 1
+                stack.append((node.right, right, prefixlen + 1))
+                stack.append((node.left, prefix, prefixlen + 1))
+
+    def _adopt_tree(self, tree):
+        # a tree built without inserts, like a merged or loaded one
+        shared, node_count, leaves = _scan_tree(tree)
+        self.tree = tree
+        self._shared_nodes = shared
+        with self._plan_lock:
+            self._node_count = node_count
+            self._leaves = weakref.WeakSet(leaves)
+
+    def _unshare(self, parent, bit, node):
+        # copy on write, the children now have one more parent
+        if type(node) is not SearchTreeNode:
+            return node
+        node = SearchTreeNode(node.left, node.right)
+        parent[bit] = node
+        for child in (node.left, node.right):
+            if type(child) is SearchTreeNode:
+                self._shared_nodes.add(id(child))
+        return node
+
+    def to_db_file(
+        self,
+        filename: str,
+        spill: Union[bool, str] = False,
+        consume: bool = False,
+        compression: Literal["gzip", "bz2", "xz"] = None,
+        compresslevel: int = None,
+        checksum: str = None,
+        traffic=None,
+        record_size: int = None,
+    ):
+        """
+        Writes the database to a file.
 
-    def _build_meta(self):
+        Args:
+           filename: The path of the output file.
+           spill: Stream the encoded data section to a temporary file while
+                  building instead of keeping it in memory. A string is used as
+                  the directory of the temporary file. Defaults to False.
+           consume: Hand the tree over to the file writer, which frees nodes,
+                    values and data chunks as soon as they are written. The writer
+                    is left empty afterwards. Defaults to False.
+           compression: Compress the output while writing it, "gzip", "bz2" or
+                        "xz". Defaults to None.
+           compresslevel: The compression level (the preset for "xz"). Defaults
+                          to the level of the compression module.
+           checksum: A hashlib algorithm, e.g. "sha256". The digest of the written
+                     file is stored in "<filename>.<checksum>" in the format of
+                     sha256sum. Defaults to None.
+           traffic: A sample of lookups: addresses or networks, optionally paired
+                    with a weight. The nodes and values these lookups visit are
+                    placed at the start of their sections, hottest first, so
+                    readers touch fewer pages. Defaults to None.
+           record_size: The smallest record size to use, 24, 28 or 32. Defaults to
+                        the smallest one the database fits in.
+        """
+        for _ in self._iter_to_db_file(
+            filename,
+            spill,
+            consume,
+            compression,
+            compresslevel,
+            checksum,
+            traffic,
+            record_size,
+        ):
+            pass
+
+    def _iter_to_db_file(
+        self,
+        filename,
+        spill=False,
+        consume=False,
+        compression=None,
+        compresslevel=None,
+        checksum=None,
+        traffic=None,
+        record_size=None,
+    ):
+        weights = None
+        if traffic is not None:
+            weights = _traffic_weights(traffic, 128 if self.ip_version == 6 else 32)
+        fingerprint = None
+        if self._fingerprint is not None:
+            output_options = (compression, compresslevel)
+            if weights:
+                output_options += (sorted(weights.items()),)
+            if record_size:
+                output_options += (record_size,)
+            fingerprint = self._build_fingerprint(output_options)
+            if consume:
+                self._fingerprint = hashlib.sha256()
+                self._insert_digest_sum = 0
+            if self._reuse_output(filename, fingerprint, compression, checksum):
+                if consume:
+                    self._adopt_tree(SearchTreeNode())
+                return
+
+        tree_writer = TreeWriter(
+            self.tree,
+            self._build_meta(),
+            self.int_type,
+            self.float_type,
+            spill=spill,
+            consume=consume,
+            weights=weights,
+            record_size=record_size,
+        )
+        if consume:
+            # The tree writer must hold the only reference for nodes to be freed.
+            self._adopt_tree(SearchTreeNode())
+        if fingerprint is not None:
+            _remove_if_exists(_buildinfo_path(filename))
+        yield from tree_writer.iter_write(
+            filename, compression, compresslevel, checksum
+        )
+        if fingerprint is not None:
+            _write_buildinfo(
+                filename,
+                {
+                    "fingerprint": fingerprint,
+                    "node_count": tree_writer._node_counter,
+                    "record_size": tree_writer.record_size,
+                    "metadata_start": tree_writer.metadata_start,
+                },
+            )
+
+    def _build_fingerprint(self, output_options=()):
+        fingerprint = self._fingerprint.copy()
+        if self._stripe_locks is not None:
+            fingerprint.update(self._insert_digest_sum.to_bytes(32, "big"))
+        meta = self._build_meta()
+        del meta["build_epoch"]
+        options = self._state_options()
+        fingerprint.update(repr(sorted({**options, **meta}.items())).encode())
+        fingerprint.update(repr(output_options).encode())
+        # a new version may write the same input differently
+        fingerprint.update(__version__.encode())
+        return fingerprint.hexdigest()
+
+    def _reuse_output(self, filename, fingerprint, compression=None, checksum=None):
+        import json
+
+        try:
+            with open(_buildinfo_path(filename)) as f:
+                info = json.load(f)
+            if info["fingerprint"] != fingerprint:
+                return False
+            if os.path.getsize(filename) != info["size"]:
+                return False
+        except (OSError, ValueError, KeyError):
+            return False
+
+        if self.cache_epoch == "refresh":
+            if compression is not None:
+                # the metadata of a compressed file can't be patched in place
+                return False
+            meta = {
+                "node_count": info["node_count"],
+                "record_size": info["record_size"],
+                **self._build_meta(),
+            }
+            with open(filename, "r+b") as f:
+                f.seek(info["metadata_start"])
+                f.write(METADATA_MAGIC)
+                f.write(Encoder(cache=False).encode_meta(meta))
+                f.truncate()
+            _write_buildinfo(filename, info)
+        if checksum:
+            # an existing checksum file may be older than the reused output
+            _write_checksum(filename, checksum, _file_digest(filename, checksum))
+        logger.debug("Reusing %s, fingerprint %s", filename, fingerprint)
+        return True
+
+    def _state_options(self):
         return {
             "ip_version": self.ip_version,
             "database_type": self.database_type,
             "languages": self.languages,
+            "description": self.description,
+            "ipv4_compatible": self.ipv4_compatible,
+            "int_type": self.int_type,
+            "float_type": self.float_type,
+        }
+
+    def save_state(self, path: str):
+        """
+        Saves the writer (options and search tree) to a compact binary snapshot.
+
+        The snapshot stores the tree as a flat array of uint32 record pairs plus a
+        deduplicated value table, so it can be loaded with :meth:`load_state` to
+        resume or fork a build without re-inserting every network.
+
+        Note:
+           The value table is pickled, only load snapshots from trusted sources.
+        """
+        import pickle
+
+        nodes = [self.tree]
+        node_idx = {id(self.tree): 0}
+        records = array("I")
+        leaf_idx = {}
+        leaf_values = array("I")
+        value_idx = {}
+        values = []
+
+        def record(child):
+            if child is None:
+                return 0
+            elif type(child) is SearchTreeNode:
+                idx = node_idx.get(id(child))
+                if idx is None:
+                    idx = node_idx[id(child)] = len(nodes)
+                    nodes.append(child)
+                return idx
+            elif type(child) is SearchTreeLeaf:
+                idx = leaf_idx.get(id(child))
+                if idx is None:
+                    idx = leaf_idx[id(child)] = len(leaf_values)
+                    key = _state_key(child.value)
+                    if key not in value_idx:
+                        value_idx[key] = len(values)
+                        values.append(child.value)
+                    leaf_values.append(value_idx[key])
+                return -1 - idx
+            else:
+                raise Exception("unexpected type")
+
+        # Nodes are numbered breadth-first, the root is always node 0, so a
+        # record of 0 can stand for an empty branch. Leaf records are stored as
+        # negative numbers until the final node count is known.
+        pending = []
+        index = 0
+        while index < len(nodes):
+            node = nodes[index]
+            pending.append(record(node.left))
+            pending.append(record(node.right))
+            index += 1
+
+        node_count = len(nodes)
+        if node_count + len(leaf_values) > UINT32_MAX:
+            raise ValueError("tree is too large to be saved")
+        for r in pending:
+            records.append(r if r >= 0 else node_count - 1 - r)
+
+        if sys.byteorder != "little":
+            records.byteswap()
+            leaf_values.byteswap()
+        value_table = pickle.dumps(
+            (self._state_options(), values), protocol=pickle.HIGHEST_PROTOCOL
+        )
+        with open(path, "wb") as f:
+            f.write(
+                _STATE_HEADER.pack(
+                    STATE_MAGIC, node_count, len(leaf_values), len(value_table)
+                )
+            )
+            records.tofile(f)
+            leaf_values.tofile(f)
+            f.write(value_table)
+
+    @classmethod
+    def load_state(cls, path: str, **kwargs) -> "MMDBWriter":
+        """
+        Loads a writer saved by :meth:`save_state`.
+
+        The returned writer is independent of the snapshot, further inserts can
+        be made on it, and the same snapshot can be loaded any number of times.
+        Keyword arguments are passed to the constructor and override the saved
+        options.
+        """
+        import mmap
+        import pickle
+
+        with open(path, "rb") as f:
+            header = f.read(_STATE_HEADER.size)
+            if len(header) != _STATE_HEADER.size:
+                raise ValueError(f"{path} is not a MMDBWriter state file")
+            magic, node_count, leaf_count, value_table_len = _STATE_HEADER.unpack(
+                header
+            )
+            if magic != STATE_MAGIC:
+                raise ValueError(f"{path} is not a MMDBWriter state file")
+
+            records_start = _STATE_HEADER.size
+            leaves_start = records_start + node_count * 8
+            values_start = leaves_start + leaf_count * 4
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if len(mm) != values_start + value_table_len:
+                    raise ValueError(f"{path} is truncated")
+                view = memoryview(mm)
+                records = _native_uint32(view[records_start:leaves_start])
+                leaf_values = _native_uint32(view[leaves_start:values_start])
+                try:
+                    options, values = pickle.loads(view[values_start:])
+
+                    writer = cls(**{**options, **kwargs})
+                    if writer._fingerprint is not None:
+                        writer._fingerprint.update(hashlib.sha256(view).digest())
+                    nodes = [SearchTreeNode() for _ in range(node_count)]
+                    leaves = [SearchTreeLeaf(values[v]) for v in leaf_values]
+                    children = nodes + leaves
+                    children[0] = None
+                    for index, node in enumerate(nodes):
+                        node.left = children[records[index * 2]]
+                        node.right = children[records[index * 2 + 1]]
+                finally:
+                    for buf in (records, leaf_values, view):
+                        if isinstance(buf, memoryview):
+                            buf.release()
+
+        writer._adopt_tree(nodes[0])
+        return writer
+
+    def plan(self, record_size: int = None, exact: bool = True) -> BuildPlan:
+        """
+        Computes the sizes of the database without writing it.
+
+        The exact plan numbers the tree and encodes every distinct value exactly
+        like :meth:`to_db_file` does, but encoded values are only measured, not
+        kept. This costs about as much time as encoding the database, and keeps
+        the value cache of a write in memory, so it only saves the output I/O.
+
+        The estimated plan uses the node count and the leaves kept during
+        inserts, and only encodes up to PLAN_SAMPLE_VALUES distinct values, so it
+        is cheap enough to check a long build as it runs. Its node and leaf
+        counts are exact. Its data size is exact when there are no more distinct
+        values than that, and otherwise scaled from the sample, which overstates
+        it when equal values are inserted as separate objects.
+
+        Args:
+           record_size: The smallest record size to use, like the `record_size`
+                        of :meth:`to_db_file`. Defaults to the smallest one the
+                        database fits in.
+           exact: Whether to encode every value, or to estimate the data size
+                  from a sample. Defaults to True.
+
+        Returns:
+           A BuildPlan with the node count, the number of distinct leaves, the
+           data section size in bytes, the record size in bits and the size of
+           the file in bytes.
+
+        Raises:
+           Exception: If the database does not fit in a 32 bit record size, like
+                      :meth:`to_db_file` would.
+        """
+        if record_size not in (None, 24, 28, 32):
+            raise ValueError(
+                f"record_size should be 24, 28 or 32, {record_size} is incorrect"
+            )
+        encoder = _SizingEncoder(
+            cache=True, int_type=self.int_type, float_type=self.float_type
+        )
+        if exact:
+            tree_writer = TreeWriter(
+                self.tree, self._build_meta(), encoder=encoder, record_size=record_size
+            )
+            tree_writer.prepare()
+            node_count = tree_writer._node_counter
+            leaf_count = len(tree_writer._leaf_offset)
+            data_size = encoder.data_pointer
+        else:
+            with self._plan_lock:
+                node_count = self._node_count
+                leaves = list(self._leaves)
+            leaf_count = len(leaves)
+            values = list({id(leaf.value): leaf.value for leaf in leaves}.values())
+            step = (len(values) + PLAN_SAMPLE_VALUES - 1) // PLAN_SAMPLE_VALUES
+            sample = values[:: step or 1]
+            for value in sample:
+                encoder.encode(value)
+            data_size = encoder.data_pointer
+            if len(sample) < len(values):
+                data_size = data_size * len(values) // len(sample)
+        record_size = _record_size_for(node_count, data_size + 16, record_size or 24)
+        meta = Encoder(cache=False).encode_meta(
+            {"node_count": node_count, "record_size": record_size, **self._build_meta()}
+        )
+        return BuildPlan(
+            node_count=node_count,
+            leaf_count=leaf_count,
+            data_size=data_size,
+            record_size=record_size,
+            file_size=node_count * record_size // 4
+            + 16
+            + data_size
+            + len(METADATA_MAGIC)
+            + len(meta),
+        )
+
+    def to_db_files(
+        self,
+        outputs: dict[str, int],
+        spill: Union[bool, str] = False,
+        compression: Literal["gzip", "bz2", "xz"] = None,
+        compresslevel: int = None,
+        checksum: str = None,
+    ):
+        """
+        Writes several IP version variants of the database in one pass.
+
+        All variants share one encoder, so every value is encoded once. The IPv4
+        tree is the ::/96 subtree of the IPv6 one, and IPv4 variants are prepared
+        first so their data section is a prefix of the shared one.
+
+        Args:
+           outputs: Maps each output filename to the IP version (4 or 6) of the
+                    database written there. An IPv4 variant of an IPv6 database
+                    requires ipv4_compatible=True.
+           spill: Stream the encoded data section to a temporary file while
+                  building instead of keeping it in memory. Defaults to False.
+           compression: Compress every output, see :meth:`to_db_file`.
+           compresslevel: The compression level, see :meth:`to_db_file`.
+           checksum: Store a checksum of every output, see :meth:`to_db_file`.
+        """
+        encoder = Encoder(
+            cache=True, int_type=self.int_type, float_type=self.float_type, spill=spill
+        )
+        try:
+            tree_writers = []
+            for filename, ip_version in sorted(outputs.items(), key=lambda o: o[1]):
+                tree_writer = TreeWriter(
+                    self._variant_tree(ip_version),
+                    self._build_meta(ip_version),
+                    encoder=encoder,
+                )
+                tree_writer.prepare()
+                tree_writers.append((filename, tree_writer))
+            for filename, tree_writer in tree_writers:
+                tree_writer.write(filename, compression, compresslevel, checksum)
+        finally:
+            encoder.close()
+
+    def to_db_shards(
+        self,
+        shards: dict,
+        compression: Literal["gzip", "bz2", "xz"] = None,
+        compresslevel: int = None,
+        checksum: str = None,
+    ):
+        """
+        Writes several databases from this writer, each restricted to a set of
+        networks.
+
+        Every shard is pruned from the tree, sharing the subtrees it fully covers,
+        and written like :meth:`to_db_file`, so only the values of a shard are
+        encoded for it.
+
+        Args:
+           shards: Maps each output filename to the networks of that shard: an
+                   IPSet, or an iterable of networks (ipaddress or netaddr objects,
+                   strings) and (first, last) integer address ranges.
+           compression: Compress every output, see :meth:`to_db_file`.
+           compresslevel: The compression level, see :meth:`to_db_file`.
+           checksum: Store a checksum of every output, see :meth:`to_db_file`.
+        """
+        bit_length = 128 if self.ip_version == 6 else 32
+        trees = {
+            filename: _prune_tree(
+                self.tree, _shard_networks(networks, bit_length), bit_length
+            )
+            for filename, networks in shards.items()
+        }
+
+        for filename, tree in trees.items():
+            tree_writer = TreeWriter(
+                tree, self._build_meta(), self.int_type, self.float_type
+            )
+            tree_writer.write(filename, compression, compresslevel, checksum)
+
+    def _variant_tree(self, ip_version):
+        if ip_version not in [4, 6]:
+            raise ValueError(f"ip_version should be 4 or 6, {ip_version} is incorrect")
+        if ip_version == self.ip_version:
+            return self.tree
+        if ip_version == 6:
+            # IPv4 addresses live in ::/96 of an IPv4 compatible database.
+            tree = self.tree
+            for _ in range(96):
+                tree = SearchTreeNode(left=tree)
+            return tree
+        if not self.ipv4_compatible:
+            raise ValueError(
+                "an IPv4 database can only be derived with ipv4_compatible=True"
+            )
+        node = self.tree
+        for _ in range(96):
+            if type(node) is not SearchTreeNode:
+                break
+            node = node.left
+        if type(node) is SearchTreeNode:
+            return node
+        elif type(node) is SearchTreeLeaf:
+            return SearchTreeNode(node, node)
+        return SearchTreeNode()
+
+    def _build_meta(self, ip_version=None):
+        return {
+            "ip_version": ip_version or self.ip_version,
+            "database_type": self.database_type,
+            "languages": self.languages,
             "binary_format_major_version": self.binary_format_major_version,
             "binary_format_minor_version": self.binary_format_minor_version,
             "description": self.description,
             "build_epoch": int(time.time()),
         }
+
+
+class MMDBReader:
+    """
+    Reads the search tree and data section of a MMDB file, without decoding
+    records unless asked to.
+
+    Records are plain integers like in the file: a record below `node_count` is a
+    node index, `node_count` is an empty branch and larger ones point into the
+    data section, see :meth:`data_offset`.
+    """
+
+    def __init__(self, path: str):
+        import mmap
+
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self._mmap)
+        try:
+            meta_start = self._mmap.rfind(
+                METADATA_MAGIC, max(0, len(self._mmap) - 128 * 1024)
+            )
+            if meta_start < 0:
+                raise ValueError(f"{path} has no MaxMind DB metadata")
+            meta_start += len(METADATA_MAGIC)
+            self.metadata = _decode(self.buf, meta_start, meta_start)[0]
+            self.node_count = self.metadata["node_count"]
+            self.record_size = self.metadata["record_size"]
+            self.ip_version = self.metadata["ip_version"]
+            if self.record_size not in (24, 28, 32):
+                raise ValueError(f"unsupported record_size={self.record_size}")
+            self.node_size = self.record_size // 4
+            self.data_start = self.node_count * self.node_size + 16
+            self.data = self.buf[self.data_start : meta_start - len(METADATA_MAGIC)]
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def bit_length(self):
+        return 128 if self.ip_version == 6 else 32
+
+    def read_node(self, index: int) -> tuple[int, int]:
+        """Returns the left and right record of node `index`."""
+        pos = index * self.node_size
+        b = self.buf[pos : pos + self.node_size]
+        if self.record_size == 24:
+            return int.from_bytes(b[:3], "big"), int.from_bytes(b[3:], "big")
+        elif self.record_size == 28:
+            left = ((b[3] >> 4) << 24) | int.from_bytes(b[:3], "big")
+            right = ((b[3] & 0x0F) << 24) | int.from_bytes(b[4:], "big")
+            return left, right
+        return int.from_bytes(b[:4], "big"), int.from_bytes(b[4:], "big")
+
+    def data_offset(self, record: int) -> int:
+        """Returns the data section offset a data record points to."""
+        return record - self.node_count - 16
+
+    def decode(self, offset: int):
+        """Decodes the value at `offset` of the data section."""
+        return _decode(self.data, offset)[0]
+
+    def raw(self, offset: int, memo: dict = None) -> MmdbRaw:
+        """Copies the value at `offset` of the data section without decoding it."""
+        return MmdbRaw.from_section(self.data, offset, memo)
+
+    def close(self):
+        if getattr(self, "data", None) is not None:
+            self.data.release()
+        self.buf.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _reader_root(reader, bit_length):
+    # IPv4 databases are walked as ::/96 of an IPv6 tree, negative records count
+    # the padding nodes left above their root.
+    return 0 if reader.bit_length == bit_length else -96
+
+
+def _reader_children(reader, record):
+    if record < 0:
+        return (record + 1 if record < -1 else 0), reader.node_count
+    elif record < reader.node_count:
+        return reader.read_node(record)
+    # data and empty records cover both halves
+    return record, record
+
+
+class _TreeMerger:
+    def __init__(self, readers, bit_length, merge):
+        self.readers = readers
+        self.bit_length = bit_length
+        self.merge = merge
+        self._nodes = {}
+        self._leaves = {}
+        self._values = {}
+        self._raw_memo = [{} for _ in readers]
+
+    def root(self):
+        return tuple(_reader_root(reader, self.bit_length) for reader in self.readers)
+
+    def _leaf(self, states):
+        if self.merge is None:
+            for index, (reader, state) in enumerate(zip(self.readers, states)):
+                if state > reader.node_count:
+                    key = (index, state)
+                    if key not in self._leaves:
+                        raw = reader.raw(
+                            reader.data_offset(state), self._raw_memo[index]
+                        )
+                        self._leaves[key] = SearchTreeLeaf(raw)
+                    return self._leaves[key]
+            return None
+
+        if states not in self._leaves:
+            values = []
+            for index, (reader, state) in enumerate(zip(self.readers, states)):
+                if state > reader.node_count:
+                    key = (index, state)
+                    if key not in self._values:
+                        self._values[key] = reader.decode(reader.data_offset(state))
+                    values.append(self._values[key])
+                else:
+                    values.append(None)
+            value = self.merge(values)
+            self._leaves[states] = None if value is None else SearchTreeLeaf(value)
+        return self._leaves[states]
+
+    def walk(self, states, depth=0):
+        if self.merge is None:
+            # the first source with data or a subtree decides
+            for reader, state in zip(self.readers, states):
+                if state != reader.node_count:
+                    if state > reader.node_count:
+                        return self._leaf(states)
+                    break
+            else:
+                return None
+        elif all(
+            state >= reader.node_count for reader, state in zip(self.readers, states)
+        ):
+            return self._leaf(states)
+
+        # Subtrees reachable through several paths, like IPv4 aliases in IPv6
+        # databases, are merged once.
+        node = self._nodes.get(states)
+        if node is not None:
+            return node
+        if depth >= self.bit_length:
+            raise ValueError("search tree is deeper than the address length")
+        children = [
+            _reader_children(reader, state)
+            for reader, state in zip(self.readers, states)
+        ]
+        left = self.walk(tuple(c[0] for c in children), depth + 1)
+        right = self.walk(tuple(c[1] for c in children), depth + 1)
+        if left is right and type(left) is SearchTreeLeaf:
+            return left
+        node = self._nodes[states] = SearchTreeNode(left, right)
+        return node
+
+
+def merge_databases(sources: list[str], merge=None, **kwargs) -> MMDBWriter:
+    """
+    Merges several MMDB files into one writer by walking their search trees
+    together.
+
+    Args:
+       sources: Paths of the databases, in order of precedence.
+       merge: By default the record of the first source that has data for a
+              network wins, and is copied as an MmdbRaw without being decoded.
+              With a merge function, it is called once for every distinct
+              combination of overlapping records with the list of decoded values
+              (None where a source has no data) and returns the value to store,
+              or None for no data.
+       kwargs: Passed to MMDBWriter. By default the ip_version is the largest of
+               the sources, IPv4 sources are stored as ::/96 in IPv6 databases,
+               and the database_type, languages and description are taken from
+               the first source. With build_cache=True the fingerprint covers
+               the contents of the sources and the name of the merge function,
+               but not its code.
+
+    Returns:
+       A MMDBWriter holding the merged tree, more networks can be inserted
+       before writing it with :meth:`MMDBWriter.to_db_file`. Subtrees reachable
+       through several networks, like IPv4 aliases, stay shared until an insert
+       changes one of them, which gets its own copy.
+    """
+    readers = []
+    try:
+        for path in sources:
+            readers.append(MMDBReader(path))
+        ip_version = max(reader.ip_version for reader in readers)
+        meta = readers[0].metadata
+        options = {
+            "ip_version": ip_version,
+            "ipv4_compatible": ip_version == 6,
+            "database_type": meta.get("database_type", "GeoIP"),
+            "languages": meta.get("languages", []),
+            "description": meta.get("description", {}),
+            **kwargs,
+        }
+        writer = MMDBWriter(**options)
+        if writer._fingerprint is not None:
+            # the tree is not inserted, so the sources stand in for it
+            for reader in readers:
+                writer._fingerprint.update(hashlib.sha256(reader.buf).digest())
+            if merge is not None:
+                name = f"{merge.__module__}.{merge.__qualname__}"
+                writer._fingerprint.update(name.encode())
+        merger = _TreeMerger(readers, writer._bit_length, merge)
+        tree = merger.walk(merger.root())
+        if type(tree) is SearchTreeLeaf:
+            tree = SearchTreeNode(tree, tree)
+        writer._adopt_tree(tree or SearchTreeNode())
+        return writer
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+class _ReaderTree:
+    """Walks the search tree of a MMDBReader by its records."""
+
+    def __init__(self, reader, bit_length):
+        self.reader = reader
+        self.root = _reader_root(reader, bit_length)
+        self.empty = reader.node_count
+        self._encoder = Encoder(cache=False)
+        self._raw_memo = {}
+
+    def is_node(self, state):
+        return state < self.reader.node_count
+
+    def children(self, state):
+        return _reader_children(self.reader, state)
+
+    def canonical(self, state):
+        """The value with pointers resolved, as bytes comparable across trees."""
+        raw = self.reader.raw(self.reader.data_offset(state), self._raw_memo)
+        return self._encoder.encode(raw)
+
+
+class _WriterTree:
+    """Walks the search tree of a MMDBWriter by its nodes."""
+
+    def __init__(self, writer, bit_length):
+        self.root = writer.tree
+        if writer._bit_length != bit_length:
+            self.root = writer._variant_tree(6)
+        self.empty = None
+        self._encoder = Encoder(
+            cache=False, int_type=writer.int_type, float_type=writer.float_type
+        )
+
+    def is_node(self, state):
+        return type(state) is SearchTreeNode
+
+    def children(self, state):
+        if type(state) is SearchTreeNode:
+            return state.left, state.right
+        return state, state
+
+    def canonical(self, state):
+        return self._encoder.encode(state.value)
+
+
+class _TreeDiffer:
+    def __init__(self, old, new, bit_length):
+        self.old = old
+        self.new = new
+        self.bit_length = bit_length
+        self.same_tree = old is new
+        self._old_keys = {}
+        self._new_keys = {}
+
+    @staticmethod
+    def _key(tree, keys, state):
+        if state == tree.empty:
+            return None
+        if state not in keys:
+            keys[state] = tree.canonical(state)
+        return keys[state]
+
+    def walk(self, old, new, depth=0, prefix=0):
+        """
+        Returns the changes below the given states as a list of ``(prefix,
+        prefixlen, old_key, new_key)`` tuples.
+        """
+        old_is_node = self.old.is_node(old)
+        new_is_node = self.new.is_node(new)
+        if not old_is_node and not new_is_node:
+            # Values are compared by their pointer free encoding, equal offsets
+            # are only encoded once.
+            old_key = self._key(self.old, self._old_keys, old)
+            new_key = self._key(self.new, self._new_keys, new)
+            if old_key == new_key or (
+                old_key is not None
+                and new_key is not None
+                and _decode(old_key, 0)[0] == _decode(new_key, 0)[0]
+            ):
+                return []
+            return [(prefix, depth, old_key, new_key)]
+        if self.same_tree and old == new:
+            return []
+        if depth >= self.bit_length:
+            raise ValueError("search tree is deeper than the address length")
+
+        old_left, old_right = self.old.children(old)
+        new_left, new_right = self.new.children(new)
+        right_prefix = prefix | 1 << (self.bit_length - depth - 1)
+        left = self.walk(old_left, new_left, depth + 1, prefix)
+        right = self.walk(old_right, new_right, depth + 1, right_prefix)
+        if (
+            len(left) == 1
+            and len(right) == 1
+            and left[0][1] == right[0][1] == depth + 1
+            and left[0][2:] == right[0][2:]
+        ):
+            # both halves changed the same way
+            return [(prefix, depth, *left[0][2:])]
+        return left + right
+
+
+def diff_databases(old, new) -> list:
+    """
+    Compares two databases by walking their search trees together.
+
+    Args:
+       old: A MMDBWriter, MMDBReader or the path of a MMDB file.
+       new: A MMDBWriter, MMDBReader or the path of a MMDB file.
+
+    Returns:
+       The minimal list of changed networks as ``(network, old_value, new_value)``
+       tuples, where a value is None if the network had no data. IPv4 databases
+       are compared as ::/96 of IPv6 ones.
+    """
+    readers = []
+    try:
+        sources = []
+        for source in (old, new):
+            if not isinstance(source, (MMDBWriter, MMDBReader)):
+                source = MMDBReader(source)
+                readers.append(source)
+            sources.append(source)
+        bit_length = max(
+            s._bit_length if isinstance(s, MMDBWriter) else s.bit_length
+            for s in sources
+        )
+        trees = [
+            _WriterTree(s, bit_length)
+            if isinstance(s, MMDBWriter)
+            else _ReaderTree(s, bit_length)
+            for s in sources
+        ]
+        if old is new:
+            trees[1] = trees[0]
+        differ = _TreeDiffer(trees[0], trees[1], bit_length)
+        changes = differ.walk(trees[0].root, trees[1].root)
+        return [
+            (
+                _ip_network(prefix, prefixlen, bit_length),
+                None if old_key is None else _decode(old_key, 0)[0],
+                None if new_key is None else _decode(new_key, 0)[0],
+            )
+            for prefix, prefixlen, old_key, new_key in changes
+        ]
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+class DatabaseIssue(NamedTuple):
+    """A problem found by :func:`verify_database`."""
+
+    section: str  # "metadata", "search tree" or "data"
+    offset: int  # offset in the file
+    message: str
+
+
+_METADATA_TYPES = {
+    "node_count": int,
+    "record_size": int,
+    "ip_version": int,
+    "database_type": str,
+    "binary_format_major_version": int,
+    "binary_format_minor_version": int,
+    "build_epoch": int,
+    "languages": list,
+    "description": dict,
+}
+_OPTIONAL_METADATA = {"languages", "description"}
+# state of a node during a walk: 0 not seen, 1 on the current path, 2 done
+_VISITED_BITS = bytes.maketrans(b"\x00\x01\x02", b"011")
+
+
+def verify_database(path: str, workers: int = None) -> list:
+    """
+    Checks the whole structure of a MMDB file.
+
+    Every record must point to a node, the empty record or a value in the data
+    section, nodes must not loop or go deeper than the address length, values and
+    pointers must decode, and every node and value must be reachable. Subtrees of
+    the search tree are walked by worker processes while another one scans the
+    data section.
+
+    Args:
+        path: The path of the database.
+        workers: The number of worker processes. Defaults to the number of CPUs,
+                 with 1 (or 0) everything is checked in this process.
+
+    Returns:
+        The list of DatabaseIssue ordered by offset, empty for a sound database.
+    """
+    import mmap
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        meta_pos = -1
+        if size:  # an empty file can't be mapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                meta_pos = buf.rfind(METADATA_MAGIC, max(0, size - 128 * 1024))
+    if meta_pos < 0:
+        return [DatabaseIssue("metadata", size, "no metadata marker found")]
+    try:
+        reader = MMDBReader(path)
+    except (ValueError, KeyError, TypeError) as e:
+        return [DatabaseIssue("metadata", meta_pos, f"invalid metadata: {e!r}")]
+
+    with reader:
+        issues = _metadata_issues(reader, meta_pos)
+        if issues:
+            return issues
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        # The top of the tree is walked here, down to a depth with enough
+        # subtrees to keep the workers busy.
+        state = bytearray(reader.node_count)
+        offsets = set()
+        frontier = []
+        stop_depth = _split_depth(reader, workers * 4) if workers > 1 else None
+        _walk_subtrees(reader, [(0, 0)], state, issues, offsets, stop_depth, frontier)
+        visited = _visited_bits(state)
+        del state
+
+        size = -(-len(frontier) // (workers * 4)) if frontier else 1
+        chunks = [frontier[i : i + size] for i in range(0, len(frontier), size)]
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(workers) as pool:
+                data_future = pool.submit(_verify_data, path)
+                results = list(pool.map(_verify_subtrees, [path] * len(chunks), chunks))
+                data_result = data_future.result()
+        else:
+            results = [_verify_subtrees(path, chunk) for chunk in chunks]
+            data_result = _verify_data(path)
+
+        for chunk_issues, chunk_offsets, chunk_visited in results:
+            issues += chunk_issues
+            offsets |= chunk_offsets
+            visited |= chunk_visited
+        issues += _unreachable_nodes(reader, visited)
+        data_issues, starts, pointers = data_result
+        issues += data_issues
+        issues += _data_reachability(reader, offsets, starts, pointers)
+
+    issues.sort(key=lambda issue: issue.offset)
+    return issues
+
+
+def _metadata_issues(reader, meta_pos):
+    meta = reader.metadata
+    issues = []
+    for key, expected in _METADATA_TYPES.items():
+        if key in _OPTIONAL_METADATA and key not in meta:
+            continue
+        if not isinstance(meta.get(key), expected):
+            issues.append(
+                DatabaseIssue(
+                    "metadata",
+                    meta_pos,
+                    f"{key} is missing or not a {expected.__name__}",
+                )
+            )
+    if meta.get("binary_format_major_version") != 2:
+        issues.append(
+            DatabaseIssue("metadata", meta_pos, "binary_format_major_version is not 2")
+        )
+    if reader.ip_version not in (4, 6):
+        issues.append(DatabaseIssue("metadata", meta_pos, "ip_version is not 4 or 6"))
+    if not isinstance(reader.node_count, int) or reader.node_count <= 0:
+        issues.append(DatabaseIssue("metadata", meta_pos, "node_count is not positive"))
+    elif reader.data_start > meta_pos:
+        issues.append(
+            DatabaseIssue(
+                "metadata",
+                meta_pos,
+                f"a search tree of {reader.node_count} nodes with record_size="
+                f"{reader.record_size} does not fit before the metadata",
+            )
+        )
+    if issues:
+        return issues
+
+    separator = reader.data_start - 16
+    if reader.buf[separator : reader.data_start] != bytes(16):
+        issues.append(
+            DatabaseIssue(
+                "search tree", separator, "data section separator is not zero"
+            )
+        )
+    if reader.node_count + 16 + len(reader.data) > 1 << reader.record_size:
+        issues.append(
+            DatabaseIssue(
+                "metadata",
+                meta_pos,
+                f"record_size={reader.record_size} is too small for the data section",
+            )
+        )
+    return issues
+
+
+def _split_depth(reader, subtrees):
+    """Returns the first depth with at least `subtrees` nodes."""
+    level, depth = {0}, 0
+    while len(level) < subtrees and depth < reader.bit_length - 1:
+        next_level = set()
+        for node in level:
+            for record in reader.read_node(node):
+                if record < reader.node_count:
+                    next_level.add(record)
+        if not next_level:
+            break
+        level, depth = next_level, depth + 1
+    return depth
+
+
+def _walk_subtrees(reader, roots, state, issues, offsets, stop_depth=None, stops=None):
+    """
+    Walks the subtrees of `roots`, a list of (node, depth), depth first.
+
+    The data offsets of the records found are added to `offsets`. With
+    `stop_depth`, nodes at that depth are appended to `stops` instead of walked.
+    """
+    node_count = reader.node_count
+    data_end = node_count + 16 + len(reader.data)
+    max_depth = reader.bit_length - 1
+    for root in roots:
+        stack = [root]
+        while stack:
+            node, depth = stack.pop()
+            if node < 0:
+                state[~node] = 2
+                continue
+            if state[node]:
+                continue
+            if depth == stop_depth:
+                state[node] = 2
+                stops.append((node, depth))
+                continue
+            state[node] = 1
+            stack.append((~node, depth))
+            for side, record in zip(("left", "right"), reader.read_node(node)):
+                if record < node_count:
+                    if depth == max_depth:
+                        message = f"goes below the last address bit to node {record}"
+                    elif state[record] == 1:
+                        message = f"loops back to node {record}"
+                    else:
+                        if state[record] == 0:
+                            stack.append((record, depth + 1))
+                        continue
+                elif record == node_count:
+                    continue
+                elif node_count + 16 <= record < data_end:
+                    offsets.add(record - node_count - 16)
+                    continue
+                else:
+                    message = f"points to {record}, outside the data section"
+                issues.append(
+                    DatabaseIssue(
+                        "search tree",
+                        node * reader.node_size,
+                        f"{side} record of node {node} {message}",
+                    )
+                )
+
+
+def _visited_bits(state):
+    """Packs the walked nodes of `state` into an int, bit i for node i."""
+    return int(bytes(state.translate(_VISITED_BITS)[::-1]), 2)
+
+
+def _verify_subtrees(path, roots):
+    with MMDBReader(path) as reader:
+        issues = []
+        offsets = set()
+        state = bytearray(reader.node_count)
+        _walk_subtrees(reader, roots, state, issues, offsets)
+        return issues, offsets, _visited_bits(state)
+
+
+def _verify_data(path):
+    """
+    Scans the data section value by value.
+
+    Returns the issues, the offsets of the values and the pointers of every value
+    as {value offset: [target offsets]}.
+    """
+    with MMDBReader(path) as reader:
+        data = reader.data
+        issues = []
+        starts = array("Q")
+        pointers = {}
+
+        def on_pointer(start, end, target):
+            found.append((start, target))
+
+        pos = 0
+        while pos < len(data):
+            found = []
+            try:
+                end = _skip_value(data, pos, on_pointer)
+            except ValueError as e:
+                issues.append(
+                    DatabaseIssue(
+                        "data", reader.data_start + pos, f"invalid value: {e}"
+                    )
+                )
+                break
+            starts.append(pos)
+            if found:
+                pointers[pos] = found
+            pos = end
+
+        values = set(starts)
+        for value, found in pointers.items():
+            targets = []
+            for start, target in found:
+                if target not in values:
+                    message = f"pointer to {target} is not the start of a value"
+                elif data[target] >> 5 == MMDBTypeID.POINTER:
+                    message = f"pointer to {target} points to another pointer"
+                else:
+                    targets.append(target)
+                    continue
+                issues.append(DatabaseIssue("data", reader.data_start + start, message))
+            pointers[value] = targets
+        return issues, starts, pointers
+
+
+def _unreachable_nodes(reader, visited):
+    missing = ((1 << reader.node_count) - 1) & ~visited
+    if not missing:
+        return []
+    bits = format(missing, f"0{reader.node_count}b")[::-1]
+    issues = []
+    for run in re.finditer("1+", bits):
+        first, last = run.start(), run.end() - 1
+        nodes = f"node {first} is" if first == last else f"nodes {first}-{last} are"
+        issues.append(
+            DatabaseIssue(
+                "search tree", first * reader.node_size, f"{nodes} unreachable"
+            )
+        )
+    return issues
+
+
+def _data_reachability(reader, offsets, starts, pointers):
+    issues = []
+    values = set(starts)
+    bad = {offset for offset in offsets if offset not in values}
+    if bad:
+        # find the records to report them, only needed for broken files
+        records = {offset + reader.node_count + 16 for offset in bad}
+        for node in range(reader.node_count):
+            for side, record in zip(("left", "right"), reader.read_node(node)):
+                if record in records:
+                    issues.append(
+                        DatabaseIssue(
+                            "search tree",
+                            node * reader.node_size,
+                            f"{side} record of node {node} points to "
+                            f"{record - reader.node_count - 16}, which is not the "
+                            f"start of a value",
+                        )
+                    )
+
+    state = {}
+    for root in offsets - bad:
+        stack = [root]
+        while stack:
+            value = stack.pop()
+            if value < 0:
+                state[~value] = 2
+                continue
+            if value in state:
+                continue
+            state[value] = 1
+            stack.append(~value)
+            for target in pointers.get(value, ()):
+                if state.get(target) == 1:
+                    issues.append(
+                        DatabaseIssue(
+                            "data",
+                            reader.data_start + value,
+                            f"value at {value} loops back to the value at {target}",
+                        )
+                    )
+                elif target not in state:
+                    stack.append(target)
+
+    run = None
+    for value in [*starts, None]:
+        if value is not None and value not in state:
+            run = run or [value, value]
+            run[1] = value
+        elif run is not None:
+            first, last = run
+            where = (
+                f"value at {first} is"
+                if first == last
+                else (f"values at {first}-{last} are")
+            )
+            issues.append(
+                DatabaseIssue("data", reader.data_start + first, f"{where} unreachable")
+            )
+            run = None
+    return issues
+
+
+_STEPS_DONE = object()
+
+
+class AsyncMMDBWriter:
+    """
+    asyncio facade over a MMDBWriter.
+
+    Inserts and the steps of writing run in an executor, so the event loop stays
+    responsive while building. Calls on the same AsyncMMDBWriter run one at a
+    time, as the writer is not safe to change from several threads at once. The
+    wrapped writer should not be used from other threads at the same time unless
+    it was created with thread_safe=True.
+    """
+
+    def __init__(self, writer: MMDBWriter = None, executor=None, **kwargs):
+        """
+        Args:
+            writer: The writer to build with, by default a new MMDBWriter created
+                    with `kwargs`.
+            executor: The concurrent.futures executor to run inserts and writes
+                      in. Defaults to the default executor of the event loop.
+        """
+        self.writer = writer if writer is not None else MMDBWriter(**kwargs)
+        self.executor = executor
+        # created in the event loop, which Python < 3.10 binds it to
+        self._lock = None
+
+    def _get_lock(self):
+        import asyncio
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def _run(self, func, *args, **kwargs):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        async with self._get_lock():
+            return await loop.run_in_executor(
+                self.executor, functools.partial(func, *args, **kwargs)
+            )
+
+    async def insert_network(self, network: "Network", content: MMDBType):
+        """Inserts a network, see :meth:`MMDBWriter.insert_network`."""
+        await self._run(self.writer.insert_network, network, content)
+
+    async def insert_from(self, items, batch_size: int = 1000):
+        """
+        Inserts every ``(network, content)`` pair of an async (or plain) iterable.
+
+        Pairs are collected in batches of `batch_size`, and every batch is
+        inserted in the executor while the next one is being received.
+        """
+        import asyncio
+
+        pending = None
+        if hasattr(items, "__aiter__"):
+            items = _aiter_batches(items, batch_size)
+        else:
+            items = _iter_batches(items, batch_size)
+        async for batch in items:
+            if pending is not None:
+                await pending
+            pending = asyncio.ensure_future(self._run(self._insert_batch, batch))
+        if pending is not None:
+            await pending
+
+    def _insert_batch(self, batch):
+        for network, content in batch:
+            self.writer.insert_network(network, content)
+
+    async def to_db_file(self, filename: str, **kwargs):
+        """
+        Writes the database, see :meth:`MMDBWriter.to_db_file` for the options.
+
+        Preparing the tree and every chunk of the file are written in the
+        executor, one step at a time, and no insert runs in between. When the task
+        is cancelled, the running step is allowed to finish, then the file is
+        removed if writing it had started.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        async with self._get_lock():
+            steps = self.writer._iter_to_db_file(filename, **kwargs)
+            # the first step prepares the tree, the file is opened after it
+            opened = False
+            try:
+                while True:
+                    step = loop.run_in_executor(self.executor, next, steps, _STEPS_DONE)
+                    try:
+                        if await asyncio.shield(step) is _STEPS_DONE:
+                            return
+                    except asyncio.CancelledError:
+                        # the generator can't be closed while a step is running
+                        await asyncio.wait([step])
+                        raise
+                    opened = True
+            except BaseException:
+                steps.close()
+                if opened:
+                    _remove_if_exists(filename)
+                raise
+
+
+async def _aiter_batches(items, batch_size):
+    batch = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _iter_batches(items, batch_size):
+    import asyncio
+
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+            await asyncio.sleep(0)
+    if batch:
+        yield batch
@@ -0,0 +1,268 @@
+"""
+Benchmarks lookups in databases written with different writer options.
+
+One random dataset is written once per variant, then the lookup throughput and
+latency percentiles are measured with the Python maxminddb reader and with the
+Go and Java clients in tests/clients. A client is skipped when its toolchain is
+not installed.
+
+    python -m tests.bench_clients --networks 100000 --lookups 100000
+"""
+
+import argparse
+import ipaddress
+import json
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import maxminddb
+
+from mmdb_writer import MMDBWriter
+
+BASE_DIR = Path(__file__).parent.absolute()
+
+# name: (MMDBWriter options, to_db_file options)
+VARIANTS = {
+    "default": ({}, {}),
+    "int_type=u32": ({"int_type": "u32"}, {}),
+    "record_size=32": ({}, {"record_size": 32}),
+    "ipv6 ipv4_compatible": ({"ip_version": 6, "ipv4_compatible": True}, {}),
+    "traffic layout": ({}, {"traffic": True}),
+}
+CLIENTS = ("python", "go", "java")
+
+
+def make_dataset(networks, records, lookups, seed=0):
+    """
+    Returns random (network, value) pairs, lookup addresses and a traffic sample.
+
+    Like in real databases, a few values cover most networks and a few networks
+    get most lookups.
+    """
+    rnd = random.Random(seed)
+    values = [
+        {
+            "country": {
+                "iso_code": f"C{i % 250}",
+                "geoname_id": rnd.randrange(1 << 24),
+                "names": {"en": f"country {i % 250}", "de": f"Land {i % 250}"},
+            },
+            "asn": rnd.randrange(1, 1 << 32),
+            "isp": f"isp {i}",
+            "location": {
+                "latitude": rnd.uniform(-90, 90),
+                "longitude": rnd.uniform(-180, 180),
+                "accuracy_radius": rnd.randrange(1, 1000),
+            },
+        }
+        for i in range(records)
+    ]
+    choices = rnd.choices(
+        values, weights=[1 / (rank + 1) for rank in range(records)], k=networks
+    )
+    items = []
+    for value in choices:
+        prefixlen = rnd.randint(16, 24)
+        prefix = rnd.getrandbits(prefixlen) << 32 - prefixlen
+        items.append((ipaddress.IPv4Network((prefix, prefixlen)), value))
+
+    def sample(count):
+        hot = rnd.choices(
+            items, weights=[1 / (rank + 1) for rank in range(networks)], k=count
+        )
+        return [
+            str(network[rnd.randrange(network.num_addresses)]) for network, _ in hot
+        ]
+
+    return items, sample(lookups), sample(max(1, lookups // 10))
+
+
+def build(path, items, writer_options, file_options, traffic):
+    # overlaps are collected instead of logged one by one
+    writer = MMDBWriter(collect_overlaps=True, **writer_options)
+    for network, value in items:
+        writer.insert_network(network, value)
+    if file_options.get("traffic"):
+        file_options = {**file_options, "traffic": traffic}
+    start = time.perf_counter()
+    writer.to_db_file(str(path), **file_options)
+    return time.perf_counter() - start
+
+
+def summarize(latencies, total_ns):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return latencies[(len(latencies) - 1) * p // 100] if latencies else 0
+
+    return {
+        "lookups": len(latencies),
+        "total_ns": total_ns,
+        "p50_ns": percentile(50),
+        "p90_ns": percentile(90),
+        "p99_ns": percentile(99),
+    }
+
+
+def bench_python(path, ips, warmup=1):
+    results = {}
+    addresses = [ipaddress.ip_address(ip) for ip in ips]
+    for mode in ("MODE_MMAP_EXT", "MODE_MMAP"):
+        try:
+            reader = maxminddb.open_database(str(path), mode=getattr(maxminddb, mode))
+        except (ValueError, ImportError):
+            # the C extension is not installed
+            continue
+        with reader:
+            for _ in range(warmup):
+                for address in addresses:
+                    reader.get(address)
+            latencies = []
+            start = time.perf_counter_ns()
+            for address in addresses:
+                lookup_start = time.perf_counter_ns()
+                reader.get(address)
+                latencies.append(time.perf_counter_ns() - lookup_start)
+            total_ns = time.perf_counter_ns() - start
+        results[f"python {mode[5:].lower()}"] = summarize(latencies, total_ns)
+    return results
+
+
+def build_client(client, workdir):
+    """Builds a client and returns its command, or None without its toolchain."""
+    if client == "go":
+        if shutil.which("go") is None:
+            return None
+        binary = Path(workdir) / "go-client"
+        subprocess.run(
+            ["go", "build", "-o", str(binary), "."],
+            check=True,
+            cwd=BASE_DIR / "clients" / "go",
+        )
+        return [str(binary)]
+    if client == "java":
+        if shutil.which("mvn") is None or shutil.which("java") is None:
+            return None
+        java_dir = BASE_DIR / "clients" / "java"
+        subprocess.run(["mvn", "-q", "clean", "package"], check=True, cwd=java_dir)
+        jar = java_dir / "target" / "mmdb-test-jar-with-dependencies.jar"
+        return ["java", "-jar", str(jar)]
+    raise ValueError(f"unknown client {client}")
+
+
+def bench_client(command, path, ips_path, warmup=1):
+    result = subprocess.run(
+        [*command, "-db", str(path), "-bench", str(ips_path), "-warmup", str(warmup)],
+        check=True,
+        stdout=subprocess.PIPE,
+    )
+    return json.loads(result.stdout)
+
+
+def run_benchmarks(
+    networks=100_000,
+    records=1_000,
+    lookups=100_000,
+    clients=CLIENTS,
+    variants=None,
+    warmup=1,
+    seed=0,
+):
+    """
+    Writes the dataset once per variant and benchmarks every client on it.
+
+    Returns one dict per variant and client, with the variant, file size, record
+    size, build time, and the lookup count, total time and percentiles in ns.
+    """
+    items, ips, traffic = make_dataset(networks, records, lookups, seed)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        ips_path = Path(workdir) / "ips.txt"
+        ips_path.write_text("\n".join(ips) + "\n")
+        commands = {}
+        for client in clients:
+            if client == "python":
+                continue
+            command = build_client(client, workdir)
+            if command is None:
+                print(f"skipping {client}: toolchain not found", file=sys.stderr)
+            else:
+                commands[client] = command
+
+        for name in variants or VARIANTS:
+            writer_options, file_options = VARIANTS[name]
+            path = Path(workdir) / f"{len(results)}.mmdb"
+            build_seconds = build(path, items, writer_options, file_options, traffic)
+            with maxminddb.open_database(str(path)) as reader:
+                record_size = reader.metadata().record_size
+            info = {
+                "variant": name,
+                "file_size": path.stat().st_size,
+                "record_size": record_size,
+                "build_seconds": build_seconds,
+            }
+            timings = {}
+            if "python" in clients:
+                timings.update(bench_python(path, ips, warmup))
+            for client, command in commands.items():
+                timings[client] = bench_client(command, path, ips_path, warmup)
+            for client, timing in timings.items():
+                results.append({**info, "client": client, **timing})
+    return results
+
+
+def format_report(results):
+    lines = [
+        f"{'variant':<22} {'size':>12} {'record':>6} {'client':<16} "
+        f"{'lookups/s':>12} {'p50 us':>8} {'p90 us':>8} {'p99 us':>8}"
+    ]
+    for r in results:
+        rate = r["lookups"] / r["total_ns"] * 1e9 if r["total_ns"] else 0
+        lines.append(
+            f"{r['variant']:<22} {r['file_size']:>12} {r['record_size']:>6} "
+            f"{r['client']:<16} {rate:>12.0f} {r['p50_ns'] / 1000:>8.2f} "
+            f"{r['p90_ns'] / 1000:>8.2f} {r['p99_ns'] / 1000:>8.2f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--networks", type=int, default=100_000)
+    parser.add_argument("--records", type=int, default=1_000)
+    parser.add_argument("--lookups", type=int, default=100_000)
+    parser.add_argument(
+        "--clients", default=",".join(CLIENTS), help="comma separated clients"
+    )
+    parser.add_argument(
+        "--variants",
+        default=",".join(VARIANTS),
+        help=f"comma separated variants of: {', '.join(VARIANTS)}",
+    )
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured rounds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        networks=args.networks,
+        records=args.records,
+        lookups=args.lookups,
+        clients=args.clients.split(","),
+        variants=args.variants.split(","),
+        warmup=args.warmup,
+        seed=args.seed,
+    )
+    print(format_report(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
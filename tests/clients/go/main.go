@@ -9,11 +9,16 @@ import (
 	"math/big"
 	"net"
 	"os"
+	"sort"
+	"strings"
+	"time"
 )
 
 var (
-	db = flag.String("db", "", "Path to the MaxMind DB file")
-	ip = flag.String("ip", "", "IP address to look up")
+	db     = flag.String("db", "", "Path to the MaxMind DB file")
+	ip     = flag.String("ip", "", "IP address to look up")
+	bench  = flag.String("bench", "", "File of IP addresses to look up, one per line, printing lookup timings")
+	warmup = flag.Int("warmup", 1, "Unmeasured rounds of lookups before the benchmark")
 )
 
 type Record struct {
@@ -31,9 +36,17 @@ type Record struct {
 	Bool   bool           `json:"bool" maxminddb:"bool"`
 }
 
+type BenchResult struct {
+	Lookups int   `json:"lookups"`
+	TotalNs int64 `json:"total_ns"`
+	P50Ns   int64 `json:"p50_ns"`
+	P90Ns   int64 `json:"p90_ns"`
+	P99Ns   int64 `json:"p99_ns"`
+}
+
 func main() {
 	flag.Parse()
-	if *db == "" || *ip == "" {
+	if *db == "" || (*ip == "" && *bench == "") {
 		flag.PrintDefaults()
 		os.Exit(1)
 	}
@@ -43,6 +56,11 @@ func main() {
 	}
 	defer db.Close()
 
+	if *bench != "" {
+		runBench(db, *bench)
+		return
+	}
+
 	ip := net.ParseIP(*ip)
 
 	var record Record
@@ -57,3 +75,53 @@ func main() {
 	}
 	fmt.Println(string(data))
 }
+
+func runBench(db *maxminddb.Reader, path string) {
+	content, err := os.ReadFile(path)
+	if err != nil {
+		log.Fatal(err)
+	}
+	var ips []net.IP
+	for _, line := range strings.Fields(string(content)) {
+		ips = append(ips, net.ParseIP(line))
+	}
+
+	var record any
+	for i := 0; i < *warmup; i++ {
+		for _, ip := range ips {
+			if err := db.Lookup(ip, &record); err != nil {
+				log.Panic(err)
+			}
+		}
+	}
+	latencies := make([]int64, len(ips))
+	start := time.Now()
+	for i, ip := range ips {
+		lookupStart := time.Now()
+		if err := db.Lookup(ip, &record); err != nil {
+			log.Panic(err)
+		}
+		latencies[i] = time.Since(lookupStart).Nanoseconds()
+	}
+	total := time.Since(start).Nanoseconds()
+
+	sort.Slice(latencies, func(i, j int) bool { return latencies[i] < latencies[j] })
+	data, err := json.Marshal(BenchResult{
+		Lookups: len(ips),
+		TotalNs: total,
+		P50Ns:   percentile(latencies, 50),
+		P90Ns:   percentile(latencies, 90),
+		P99Ns:   percentile(latencies, 99),
+	})
+	if err != nil {
+		log.Panic(err)
+	}
+	fmt.Println(string(data))
+}
+
+func percentile(sorted []int64, p int) int64 {
+	if len(sorted) == 0 {
+		return 0
+	}
+	return sorted[(len(sorted)-1)*p/100]
+}
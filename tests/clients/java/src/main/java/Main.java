@@ -2,6 +2,7 @@ import com.google.gson.Gson;
 import com.maxmind.db.MaxMindDbConstructor;
 import com.maxmind.db.MaxMindDbParameter;
 import com.maxmind.db.Reader;
+import org.kohsuke.args4j.CmdLineException;
 import org.kohsuke.args4j.CmdLineParser;
 import org.kohsuke.args4j.Option;
 
@@ -9,6 +10,11 @@ import java.io.File;
 import java.io.IOException;
 import java.math.BigInteger;
 import java.net.InetAddress;
+import java.nio.file.Files;
+import java.nio.file.Paths;
+import java.util.ArrayList;
+import java.util.Arrays;
+import java.util.LinkedHashMap;
 import java.util.List;
 import java.util.Map;
 
@@ -16,15 +22,69 @@ public class Main {
     @Option(name = "-db", usage = "Path to the MMDB file", required = true)
     private String databasePath;
 
-    @Option(name = "-ip", usage = "IP address to lookup", required = true)
+    @Option(name = "-ip", usage = "IP address to lookup")
     private String ipAddress;
 
+    @Option(name = "-bench", usage = "File of IP addresses to look up, one per line, printing lookup timings")
+    private String benchPath;
+
+    @Option(name = "-warmup", usage = "Unmeasured rounds of lookups before the benchmark")
+    private int warmup = 1;
+
     public static void main(String[] args) throws Exception {
         Main lookup = new Main();
         CmdLineParser parser = new CmdLineParser(lookup);
         parser.parseArgument(args);
+        if (lookup.ipAddress == null && lookup.benchPath == null) {
+            throw new CmdLineException(parser, "either -ip or -bench is required", null);
+        }
 
-        lookup.run();
+        if (lookup.benchPath != null) {
+            lookup.bench();
+        } else {
+            lookup.run();
+        }
+    }
+
+    public void bench() throws IOException {
+        List<InetAddress> addresses = new ArrayList<>();
+        for (String line : Files.readAllLines(Paths.get(benchPath))) {
+            if (!line.isBlank()) {
+                addresses.add(InetAddress.getByName(line.strip()));
+            }
+        }
+
+        try (Reader reader = new Reader(new File(databasePath))) {
+            for (int i = 0; i < warmup; i++) {
+                for (InetAddress address : addresses) {
+                    reader.get(address, Map.class);
+                }
+            }
+            long[] latencies = new long[addresses.size()];
+            long start = System.nanoTime();
+            for (int i = 0; i < latencies.length; i++) {
+                long lookupStart = System.nanoTime();
+                reader.get(addresses.get(i), Map.class);
+                latencies[i] = System.nanoTime() - lookupStart;
+            }
+            long total = System.nanoTime() - start;
+
+            Arrays.sort(latencies);
+            Map<String, Long> result = new LinkedHashMap<>();
+            result.put("lookups", (long) latencies.length);
+            result.put("total_ns", total);
+            result.put("p50_ns", percentile(latencies, 50));
+            result.put("p90_ns", percentile(latencies, 90));
+            result.put("p99_ns", percentile(latencies, 99));
+            System.out.println(new Gson().toJson(result));
+        }
+    }
+
+    private static long percentile(long[] sorted, int p) {
+        if (sorted.length == 0) {
+            return 0;
+        }
+        return sorted[(sorted.length - 1) * p / 100];
     }
 
     public void run() throws IOException {
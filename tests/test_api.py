@@ -1,13 +1,41 @@
+import asyncio
+import bz2
+import gzip
+import hashlib
 import logging
+import lzma
 import os.path
 import random
 import struct
+import subprocess
+import sys
+import threading
+import tracemalloc
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+from unittest import mock
 
 import maxminddb
 from netaddr import IPSet
 
-from mmdb_writer import MmdbI32, MmdbU16, MmdbU32, MmdbU64, MmdbU128, MMDBWriter
+from mmdb_writer import (
+    AsyncMMDBWriter,
+    DatabaseIssue,
+    Encoder,
+    MmdbI32,
+    MmdbRaw,
+    MMDBReader,
+    MmdbU16,
+    MmdbU32,
+    MmdbU64,
+    MmdbU128,
+    MMDBWriter,
+    TreeWriter,
+    diff_databases,
+    merge_databases,
+    verify_database,
+)
 
 logging.basicConfig(
     format="[%(asctime)s: %(levelname)s] %(message)s", level=logging.INFO
@@ -19,10 +47,12 @@ record2 = {"country": "c2", "isp": "ISP2"}
 class TestBuild(unittest.TestCase):
     def setUp(self) -> None:
         self.filename = "_test.mmdb"
+        self.extra_files = []
 
     def tearDown(self) -> None:
-        if os.path.exists(self.filename):
-            os.remove(self.filename)
+        for filename in (self.filename, *self.extra_files):
+            if os.path.exists(filename):
+                os.remove(filename)
 
     def test_metadata(self):
         ip_version = 6
@@ -123,3 +153,841 @@ class TestBuild(unittest.TestCase):
                 writer.insert_network(IPSet(["1.0.0.0/8"]), {"value": bad_value})
                 with self.assertRaises((ValueError, struct.error)):
                     writer.to_db_file(self.filename)
+
+    def test_save_load_state(self):
+        state_file = "_test.state"
+        self.extra_files.append(state_file)
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True, int_type="u32")
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.insert_network(IPSet(["1.10.10.0/24", "2.0.0.0/8"]), record2)
+        writer.insert_network(IPSet(["fe80::/16"]), {"flag": True, "n": 1})
+        writer.save_state(state_file)
+
+        loaded = MMDBWriter.load_state(state_file)
+        self.assertEqual(writer.ip_version, loaded.ip_version)
+        self.assertEqual(writer.int_type, loaded.int_type)
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            writer.to_db_file(self.filename)
+            with open(self.filename, "rb") as f:
+                expected = f.read()
+            loaded.to_db_file(self.filename)
+            with open(self.filename, "rb") as f:
+                self.assertEqual(expected, f.read())
+
+        # a loaded state can be forked into independent builds
+        fork = MMDBWriter.load_state(state_file)
+        fork.insert_network(IPSet(["1.1.0.0/16"]), {"fork": 1})
+        fork.to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual({"fork": 1}, m.get("1.1.0.1"))
+        self.assertEqual(record1, m.get("1.2.0.1"))
+        self.assertEqual(record2, m.get("1.10.10.1"))
+        self.assertEqual({"flag": True, "n": 1}, m.get("fe80::1"))
+        m.close()
+
+    def test_spill(self):
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.insert_network(IPSet(["1.10.10.0/24", "2.0.0.0/8"]), record2)
+        for i in range(3, 100):
+            writer.insert_network(IPSet([f"{i}.0.0.0/16"]), {"i": i, "r": record1})
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            writer.to_db_file(self.filename)
+            with open(self.filename, "rb") as f:
+                expected = f.read()
+            writer.to_db_file(self.filename, spill=True)
+            with open(self.filename, "rb") as f:
+                self.assertEqual(expected, f.read())
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual({"i": 42, "r": record1}, m.get("42.0.0.1"))
+        m.close()
+
+    def test_consume(self):
+        def build():
+            writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+            writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+            writer.insert_network(IPSet(["1.10.10.0/24", "fe80::/16"]), record2)
+            return writer
+
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            build().to_db_file(self.filename)
+            with open(self.filename, "rb") as f:
+                expected = f.read()
+            for spill in (False, True):
+                writer = build()
+                writer.to_db_file(self.filename, spill=spill, consume=True)
+                with open(self.filename, "rb") as f:
+                    self.assertEqual(expected, f.read())
+                self.assertIsNone(writer.tree.left)
+                self.assertIsNone(writer.tree.right)
+
+    def test_consume_memory(self):
+        def peak(consume):
+            writer = MMDBWriter()
+            rnd = random.Random(0)
+            for i in range(5000):
+                writer.insert_network(
+                    IPv4Network((rnd.getrandbits(24) << 8, 24)),
+                    {"i": i % 2000, "name": f"isp {i % 2000}"},
+                )
+            tracemalloc.start()
+            try:
+                writer.to_db_file(self.filename, consume=consume)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        self.assertLess(peak(True), peak(False) * 0.6)
+
+    def test_collect_overlaps(self):
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True, collect_overlaps=True)
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.insert_network(IPSet(["2.0.0.0/8"]), record1)
+        with mock.patch("mmdb_writer.logger") as logger:
+            writer.insert_network(IPSet(["1.10.10.0/24"]), record2)
+            writer.insert_network(IPSet(["2.0.0.0/8"]), record2)
+            logger.info.assert_not_called()
+        self.assertEqual(2, len(writer.overlaps))
+        prefix, prefixlen, old_value, new_value = writer.overlaps.records[0]
+        self.assertEqual((0x01000000, 104), (prefix, prefixlen))
+        self.assertEqual(
+            [
+                (IPv6Network("::100:0/104"), record1, record2),
+                (IPv6Network("::200:0/104"), record1, record2),
+            ],
+            list(writer.overlaps),
+        )
+
+        writer = MMDBWriter(collect_overlaps=True)
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.insert_network(IPSet(["1.10.10.0/24"]), record2)
+        self.assertEqual(
+            [(IPv4Network("1.0.0.0/8"), record1, record2)], list(writer.overlaps)
+        )
+
+        # a supernet records every network it replaces
+        writer = MMDBWriter(collect_overlaps=True)
+        writer.insert_network("1.1.1.0/24", record1)
+        writer.insert_network("1.1.3.0/24", record2)
+        writer.insert_network("1.0.0.0/8", {"n": 1})
+        self.assertEqual(
+            [
+                (IPv4Network("1.1.1.0/24"), record1, {"n": 1}),
+                (IPv4Network("1.1.3.0/24"), record2, {"n": 1}),
+            ],
+            list(writer.overlaps),
+        )
+
+        # the overlaps can be inspected after a consuming build
+        writer.insert_network("1.1.0.0/16", {"n": 2})
+        writer.to_db_file(self.filename, consume=True)
+        self.assertEqual(
+            (IPv4Network("1.0.0.0/8"), {"n": 1}, {"n": 2}), list(writer.overlaps)[-1]
+        )
+
+    def test_thread_safe(self):
+        networks = [f"{i}.{j}.0.0/16" for i in range(1, 64) for j in range(0, 256, 32)]
+        networks += ["64.0.0.0/4", "80.0.0.0/5", "100.0.0.0/8", "101.0.0.0/9"]
+        random.shuffle(networks)
+
+        def build(workers, ip_version):
+            writer = MMDBWriter(
+                ip_version=ip_version,
+                ipv4_compatible=ip_version == 6,
+                thread_safe=True,
+                lock_stripe_bits=6,
+            )
+            with ThreadPoolExecutor(workers) as executor:
+                futures = [
+                    executor.submit(
+                        writer.insert_network, IPSet([network]), {"net": network}
+                    )
+                    for network in networks
+                ]
+            for future in futures:
+                future.result()
+            return writer
+
+        for ip_version in (4, 6):
+            with self.subTest(ip_version=ip_version):
+                if ip_version == 6:
+                    networks += ["0:0:0:1::/64", "::2:0:0/96", "fe80::/16", "2400::/12"]
+                    random.shuffle(networks)
+                with mock.patch("mmdb_writer.time.time", return_value=1):
+                    build(1, ip_version).to_db_file(self.filename)
+                    with open(self.filename, "rb") as f:
+                        expected = f.read()
+                    build(8, ip_version).to_db_file(self.filename)
+                    with open(self.filename, "rb") as f:
+                        self.assertEqual(expected, f.read())
+                m = maxminddb.open_database(self.filename)
+                self.assertEqual({"net": "1.32.0.0/16"}, m.get("1.32.1.1"))
+                self.assertEqual({"net": "64.0.0.0/4"}, m.get("72.0.0.1"))
+                self.assertEqual({"net": "101.0.0.0/9"}, m.get("101.1.0.1"))
+                m.close()
+
+    def test_thread_safe_ipv4_stripes(self):
+        # IPv4 networks in an IPv6 tree are not all in the first stripe
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True, thread_safe=True)
+        stripe = writer._ipv4_stripe_locks[1]
+        with stripe:
+            thread = threading.Thread(
+                target=writer.insert_network, args=("200.0.0.0/16", record1)
+            )
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+            blocked = threading.Thread(
+                target=writer.insert_network, args=("1.0.0.0/16", record2)
+            )
+            blocked.start()
+            blocked.join(0.1)
+            self.assertTrue(blocked.is_alive())
+        blocked.join(5)
+        writer.to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual(record1, m.get("200.0.1.1"))
+        self.assertEqual(record2, m.get("1.0.1.1"))
+        m.close()
+
+    def test_build_cache(self):
+        self.extra_files.append(self.filename + ".buildinfo")
+
+        def build(content, **kwargs):
+            writer = MMDBWriter(build_cache=True, **kwargs)
+            writer.insert_network(IPSet(["1.0.0.0/8"]), content)
+            writer.insert_network(IPSet(["1.10.10.0/24"]), record2)
+            return writer
+
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            build(record1).to_db_file(self.filename)
+        with mock.patch.object(
+            TreeWriter, "iter_write", autospec=True, side_effect=TreeWriter.iter_write
+        ) as write:
+            build(record1).to_db_file(self.filename)
+            write.assert_not_called()
+            build(record1, database_type="other").to_db_file(self.filename)
+            write.assert_called_once()
+            with mock.patch("mmdb_writer.__version__", "0.0.0"):
+                build(record1, database_type="other").to_db_file(self.filename)
+            self.assertEqual(2, write.call_count)
+        os.remove(self.filename + ".buildinfo")
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            build(record1).to_db_file(self.filename)
+
+        with mock.patch("mmdb_writer.time.time", return_value=2**40):
+            build(record1, cache_epoch="refresh").to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual(2**40, m.metadata().build_epoch)
+        self.assertEqual(record1, m.get("1.1.1.1"))
+        self.assertEqual(record2, m.get("1.10.10.1"))
+        m.close()
+
+        with mock.patch("mmdb_writer.time.time", return_value=3):
+            build(record1).to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual(2**40, m.metadata().build_epoch)
+        m.close()
+
+        with mock.patch("mmdb_writer.time.time", return_value=3):
+            build(record2).to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual(3, m.metadata().build_epoch)
+        self.assertEqual(record2, m.get("1.1.1.1"))
+        m.close()
+
+        # parallel inserts in a different order give the same fingerprint
+        networks = [f"{i}.{j}.0.0/16" for i in range(1, 32) for j in range(256)]
+
+        def build_threaded(seed):
+            writer = MMDBWriter(thread_safe=True, build_cache=True)
+            random.Random(seed).shuffle(networks)
+            with ThreadPoolExecutor(8) as executor:
+                values = [{"net": network} for network in networks]
+                list(executor.map(writer.insert_network, networks, values))
+            return writer
+
+        build_threaded(0).to_db_file(self.filename)
+        with mock.patch.object(
+            TreeWriter, "iter_write", autospec=True, side_effect=TreeWriter.iter_write
+        ) as write:
+            build_threaded(1).to_db_file(self.filename)
+            write.assert_not_called()
+
+        # a reused file gets a checksum of its current contents
+        self.extra_files.append(self.filename + ".sha256")
+        build(record1).to_db_file(self.filename, checksum="sha256")
+        build(record2).to_db_file(self.filename)
+        build(record2).to_db_file(self.filename, checksum="sha256")
+        with open(self.filename, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with open(self.filename + ".sha256") as f:
+            self.assertEqual(f"{digest}  {self.filename}\n", f.read())
+
+    def test_to_db_files(self):
+        filename4, filename6 = "_test4.mmdb", "_test6.mmdb"
+        self.extra_files += [filename4, filename6]
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.insert_network(IPSet(["1.10.10.0/24"]), record2)
+        writer.insert_network(IPSet(["fe80::/16"]), {"v6": True, "r": record1})
+        writer4 = MMDBWriter()
+        writer4.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer4.insert_network(IPSet(["1.10.10.0/24"]), record2)
+        for spill in (False, True):
+            with mock.patch("mmdb_writer.time.time", return_value=1):
+                writer.to_db_files({filename6: 6, filename4: 4}, spill=spill)
+                writer4.to_db_file(self.filename)
+            # the IPv4 variant only contains the records it needs
+            with open(self.filename, "rb") as f, open(filename4, "rb") as f4:
+                self.assertEqual(f.read(), f4.read())
+            m = maxminddb.open_database(filename6)
+            self.assertEqual(6, m.metadata().ip_version)
+            self.assertEqual(record2, m.get("1.10.10.1"))
+            self.assertEqual({"v6": True, "r": record1}, m.get("fe80::1"))
+            m.close()
+
+        writer4.to_db_files({filename6: 6})
+        m = maxminddb.open_database(filename6)
+        self.assertEqual(6, m.metadata().ip_version)
+        self.assertEqual(record1, m.get("1.1.1.1"))
+        self.assertEqual(record2, m.get("1.10.10.1"))
+        self.assertIsNone(m.get("fe80::1"))
+        m.close()
+        with self.assertRaises(ValueError):
+            MMDBWriter(ip_version=6).to_db_files({filename4: 4})
+
+    def test_plan(self):
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.insert_network(IPSet(["1.10.10.0/24", "2.0.0.0/8"]), record2)
+        writer.insert_network(IPSet(["fe80::/16"]), {"v6": True, "r": record1})
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            plan = writer.plan()
+            writer.to_db_file(self.filename)
+        self.assertEqual(os.path.getsize(self.filename), plan.file_size)
+        self.assertEqual(3, plan.leaf_count)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual(plan.node_count, m.metadata().node_count)
+        self.assertEqual(plan.record_size, m.metadata().record_size)
+        m.close()
+
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            plan = writer.plan(record_size=32)
+            writer.to_db_file(self.filename, record_size=32)
+        self.assertEqual(32, plan.record_size)
+        self.assertEqual(os.path.getsize(self.filename), plan.file_size)
+
+        # the estimate is kept during inserts, and exact for few distinct values
+        writer.insert_network(IPSet(["1.10.0.0/16"]), record2)
+        writer.insert_network(IPSet(["fe80::/17", "::/0"]), record1)
+        state_file = self.filename + ".state"
+        writer.save_state(state_file)
+        self.addCleanup(os.remove, state_file)
+        loaded = MMDBWriter.load_state(state_file)
+        loaded.insert_network(IPSet(["1.0.0.0/9"]), {"loaded": True})
+        merged = merge_databases([self.filename])
+        merged.insert_network(IPSet(["2.0.0.0/9"]), record1)
+        for planned in (writer, loaded, merged):
+            with mock.patch("mmdb_writer.time.time", return_value=1):
+                self.assertEqual(planned.plan(exact=False), planned.plan())
+            with mock.patch("mmdb_writer.time.time", return_value=1):
+                self.assertEqual(
+                    planned.plan(record_size=28, exact=False),
+                    planned.plan(record_size=28),
+                )
+
+        # a larger tree is not walked, and its values are sampled
+        writer = MMDBWriter()
+        for i in range(64):
+            writer.insert_network(IPSet([f"10.{i}.0.0/16"]), {"i": i})
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            plan = writer.plan()
+            with mock.patch("mmdb_writer.PLAN_SAMPLE_VALUES", 4):
+                with mock.patch.object(TreeWriter, "prepare") as prepare:
+                    estimate = writer.plan(exact=False)
+        prepare.assert_not_called()
+        self.assertEqual(plan.node_count, estimate.node_count)
+        self.assertEqual(64, estimate.leaf_count)
+        self.assertAlmostEqual(plan.data_size, estimate.data_size, delta=64)
+
+    def test_raw_value(self):
+        nested = {"names": {"en": "c1", "de": "c1"}, "codes": [1, 2**40, -1]}
+        raw1 = MmdbRaw(Encoder(cache=False).encode(record1))
+        bad_values = (
+            b"\x20\x00",
+            b"\x43ab",
+            b"\x41ab",
+            b"\x00\x05",
+            # a double must have 8 bytes and a float 4
+            bytes([0x64, 0, 0, 0, 1]),
+            b"\x08\x08" + bytes(8),
+        )
+        for bad in bad_values:
+            with self.assertRaises(ValueError):
+                MmdbRaw(bad)
+        MmdbRaw(b"\x68" + bytes(8))
+        MmdbRaw(b"\x04\x08" + bytes(4))
+
+        encoder = Encoder()
+        offset = encoder.encode({"nested": nested, "r": record2}, return_offset=True)
+        section = b"".join(encoder.data_list)
+        raw2 = MmdbRaw.from_section(section, offset)
+        self.assertIsInstance(raw2.parts[1], MmdbRaw)
+
+        writer = MMDBWriter()
+        writer.insert_network(IPSet(["1.0.0.0/8"]), raw1)
+        writer.insert_network(IPSet(["2.0.0.0/8"]), raw2)
+        writer.insert_network(IPSet(["3.0.0.0/8"]), {"raw": raw1, "n": nested})
+        writer.to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual(record1, m.get("1.1.1.1"))
+        self.assertEqual({"nested": nested, "r": record2}, m.get("2.1.1.1"))
+        self.assertEqual({"raw": record1, "n": nested}, m.get("3.1.1.1"))
+        m.close()
+
+    def test_merge_databases(self):
+        filename4, filename6 = "_test4.mmdb", "_test6.mmdb"
+        self.extra_files += [filename4, filename6]
+        writer = MMDBWriter()
+        writer.insert_network(IPSet(["1.0.0.0/8"]), {"a": 1})
+        writer.insert_network(IPSet(["1.10.0.0/16"]), {"a": 2})
+        writer.to_db_file(filename4)
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        writer.insert_network(IPSet(["1.0.0.0/16"]), {"b": 1, "names": record1})
+        writer.insert_network(IPSet(["2.0.0.0/8"]), {"b": 2, "names": record1})
+        writer.insert_network(IPSet(["fe80::/16"]), {"b": 3, "f": 0.5})
+        writer.to_db_file(filename6)
+
+        merged = merge_databases([filename4, filename6])
+        self.assertEqual(6, merged.ip_version)
+        merged.to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual({"a": 1}, m.get("1.0.0.1"))
+        self.assertEqual({"a": 2}, m.get("1.10.0.1"))
+        self.assertEqual({"b": 2, "names": record1}, m.get("2.0.0.1"))
+        self.assertEqual({"b": 3, "f": 0.5}, m.get("fe80::1"))
+        self.assertIsNone(m.get("3.0.0.1"))
+        m.close()
+
+        merge_databases([filename6, filename4]).to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual({"b": 1, "names": record1}, m.get("1.0.0.1"))
+        self.assertEqual({"a": 1}, m.get("1.1.0.1"))
+        self.assertEqual({"a": 2}, m.get("1.10.0.1"))
+        m.close()
+
+        def merge(values):
+            res = {}
+            for value in reversed(values):
+                res.update(value or {})
+            return res
+
+        merge_databases([filename4, filename6], merge).to_db_file(self.filename)
+        m = maxminddb.open_database(self.filename)
+        self.assertEqual({"a": 1, "b": 1, "names": record1}, m.get("1.0.0.1"))
+        self.assertEqual({"a": 1}, m.get("1.1.0.1"))
+        self.assertEqual({"b": 3, "f": 0.5}, m.get("fe80::1"))
+        m.close()
+
+        # the build cache tells the sources apart
+        self.extra_files.append(self.filename + ".buildinfo")
+        for sources, expected in (
+            ([filename4, filename6], {"a": 1}),
+            ([filename6, filename4], {"b": 1, "names": record1}),
+        ):
+            merge_databases(sources, build_cache=True).to_db_file(self.filename)
+            m = maxminddb.open_database(self.filename)
+            self.assertEqual(expected, m.get("1.0.0.1"))
+            m.close()
+
+    def test_merge_aliased_database(self):
+        source = "_test_source.mmdb"
+        self.extra_files.append(source)
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        writer.insert_network("1.2.0.0/16", record1)
+        writer.insert_network("::ffff:0:0/96", record2)
+        # ::ffff:0:0/96 points to the IPv4 subtree at ::/96, like in GeoLite2
+        ipv4 = writer.tree
+        for _ in range(96):
+            ipv4 = ipv4.left
+        alias_parent = writer.tree
+        for bit in range(127, 32, -1):
+            alias_parent = alias_parent[0xFFFF00000000 >> bit & 1]
+        alias_parent.right = ipv4
+        writer.to_db_file(source)
+
+        merged = merge_databases([source])
+        merged.insert_network("::ffff:1.2.3.0/120", {"alias": True})
+        merged.insert_network("2.0.0.0/8", {"ipv4": True})
+        merged.to_db_file(self.filename)
+        with maxminddb.open_database(self.filename) as m:
+            self.assertEqual({"alias": True}, m.get("::ffff:1.2.3.4"))
+            self.assertEqual(record1, m.get("1.2.3.4"))
+            self.assertEqual(record1, m.get("::ffff:1.2.4.4"))
+            self.assertEqual({"ipv4": True}, m.get("2.0.0.1"))
+            self.assertIsNone(m.get("::ffff:2.0.0.1"))
+
+    def test_compression(self):
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.insert_network(IPSet(["fe80::/16"]), record2)
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            writer.to_db_file(self.filename)
+            with open(self.filename, "rb") as f:
+                expected = f.read()
+            for compression, module in (("gzip", gzip), ("bz2", bz2), ("xz", lzma)):
+                filename = f"{self.filename}.{compression}"
+                self.extra_files += [filename, filename + ".sha256"]
+                writer.to_db_file(
+                    filename,
+                    compression=compression,
+                    compresslevel=1,
+                    checksum="sha256",
+                )
+                with open(filename, "rb") as f:
+                    compressed = f.read()
+                self.assertEqual(expected, module.decompress(compressed))
+                with open(filename + ".sha256") as f:
+                    self.assertEqual(
+                        f"{hashlib.sha256(compressed).hexdigest()}  {filename}\n",
+                        f.read(),
+                    )
+                # the checksum does not change what is written
+                writer.to_db_file(filename, compression=compression, compresslevel=1)
+                with open(filename, "rb") as f:
+                    self.assertEqual(compressed, f.read())
+        with self.assertRaises(ValueError):
+            writer.to_db_file(self.filename, compression="zip")
+
+    def test_diff_databases(self):
+        filename_old, filename_new = "_test_old.mmdb", "_test_new.mmdb"
+        self.extra_files += [filename_old, filename_new]
+        old = MMDBWriter()
+        old.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        old.insert_network(IPSet(["2.0.0.0/8"]), {"n": 2})
+        old.insert_network(IPSet(["4.0.0.0/8"]), {"n": 4})
+        old.to_db_file(filename_old)
+        new = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        new.insert_network(IPSet(["1.0.0.0/8"]), dict(record1))
+        new.insert_network(IPSet(["1.10.0.0/16"]), record2)
+        new.insert_network(IPSet(["2.0.0.0/9"]), {"n": 20})
+        new.insert_network(IPSet(["2.128.0.0/9"]), {"n": 20})
+        new.insert_network(IPSet(["3.0.0.0/8"]), {"n": 3})
+        new.insert_network(IPSet(["4.0.0.0/8"]), {"n": 4})
+        new.to_db_file(filename_new)
+
+        expected = [
+            (IPv6Network("::10a:0/112"), record1, record2),
+            (IPv6Network("::200:0/104"), {"n": 2}, {"n": 20}),
+            (IPv6Network("::300:0/104"), None, {"n": 3}),
+        ]
+        for old_source in (old, filename_old):
+            for new_source in (new, filename_new):
+                self.assertEqual(expected, diff_databases(old_source, new_source))
+        self.assertEqual([], diff_databases(filename_new, new))
+        self.assertEqual([], diff_databases(new, new))
+
+    def test_traffic_layout(self):
+        def lookup(address):
+            with MMDBReader(self.filename) as reader:
+                nodes, record = [], 0
+                while record < reader.node_count:
+                    nodes.append(record)
+                    bit = (int(IPv6Address(address)) >> 127 - len(nodes) + 1) & 1
+                    record = reader.read_node(record)[bit]
+                offset = reader.data_offset(record)
+                self.assertEqual({"n": 50}, reader.decode(offset))
+                return nodes, offset
+
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        for i in range(64):
+            writer.insert_network(IPSet([f"{i}.0.0.0/8"]), {"n": i})
+        writer.insert_network(IPSet(["2001:db8::/32"]), record2)
+        writer.to_db_file(self.filename)
+        nodes, offset = lookup("::50.1.2.3")
+        self.assertNotEqual(list(range(len(nodes))), nodes)
+
+        traffic = ["50.1.2.3", ("50.0.0.0/8", 10), "2001:db8::1", 999]
+        for consume in (False, True):
+            with self.subTest(consume=consume):
+                writer.to_db_file(self.filename, consume=consume, traffic=traffic)
+                with maxminddb.open_database(self.filename) as m:
+                    for i in range(64):
+                        self.assertEqual({"n": i}, m.get(f"{i}.1.1.1"))
+                    self.assertEqual(record2, m.get("2001:db8::1"))
+                # the nodes and value of the hottest lookup come first
+                hot_nodes, hot_offset = lookup("::50.1.2.3")
+                self.assertEqual(list(range(len(nodes))), hot_nodes)
+                self.assertLess(hot_offset, offset)
+
+    def test_verify_database(self):
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        for i in range(64):
+            writer.insert_network(IPSet([f"{i}.0.0.0/10"]), {"n": i, "l": [i, "x"]})
+        writer.insert_network(IPSet(["2001:db8::/32"]), record2)
+        writer.to_db_file(self.filename)
+        self.assertEqual([], verify_database(self.filename, workers=1))
+        self.assertEqual([], verify_database(self.filename, workers=2))
+
+        writer = MMDBWriter()
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.insert_network(IPSet(["2.0.0.0/8"]), record2)
+        writer.to_db_file(self.filename)
+        with open(self.filename, "rb") as f:
+            content = f.read()
+        # 24 bit records: node i is at 6 * i, its right record at 6 * i + 3
+        node_count = 9
+        cases = [
+            (
+                6,
+                b"\x00\x00\x00",
+                DatabaseIssue(
+                    "search tree", 6, "left record of node 1 loops back to node 0"
+                ),
+            ),
+            (
+                3,
+                b"\xff\xff\xff",
+                DatabaseIssue(
+                    "search tree",
+                    0,
+                    "right record of node 0 points to 16777215, outside the data "
+                    "section",
+                ),
+            ),
+            (
+                3,
+                (node_count + 16 + 1).to_bytes(3, "big"),
+                DatabaseIssue(
+                    "search tree",
+                    0,
+                    "right record of node 0 points to 1, which is not the start of "
+                    "a value",
+                ),
+            ),
+            (
+                node_count * 6 + 3,
+                b"\x01",
+                DatabaseIssue(
+                    "search tree", node_count * 6, "data section separator is not zero"
+                ),
+            ),
+        ]
+        for pos, patch, issue in cases:
+            with self.subTest(issue=issue):
+                with open(self.filename, "wb") as f:
+                    f.write(content[:pos] + patch + content[pos + len(patch) :])
+                issues = verify_database(self.filename, workers=1)
+                self.assertIn(issue, issues)
+                self.assertEqual(issues, verify_database(self.filename, workers=2))
+
+        meta_pos = content.rindex(b"\xab\xcd\xefMaxMind.com")
+        with open(self.filename, "wb") as f:
+            f.write(content[:-10])
+        self.assertEqual(
+            [("metadata", meta_pos)],
+            [issue[:2] for issue in verify_database(self.filename)],
+        )
+        with open(self.filename, "wb") as f:
+            f.write(content[:meta_pos])
+        self.assertEqual(
+            [DatabaseIssue("metadata", meta_pos, "no metadata marker found")],
+            verify_database(self.filename),
+        )
+        with open(self.filename, "wb") as f:
+            pass
+        self.assertEqual(
+            [DatabaseIssue("metadata", 0, "no metadata marker found")],
+            verify_database(self.filename),
+        )
+
+        # a double of 4 bytes, which readers reject
+        writer = MMDBWriter()
+        writer.insert_network("1.0.0.0/8", {"d": 0.5})
+        writer.to_db_file(self.filename)
+        with open(self.filename, "rb") as f:
+            content = f.read()
+        pos = content.index(b"\x68" + struct.pack(">d", 0.5))
+        with open(self.filename, "wb") as f:
+            f.write(content[:pos] + b"\x64" + content[pos + 1 :])
+        issues = verify_database(self.filename, workers=1)
+        self.assertTrue(
+            any(
+                issue[:2] == ("data", pos) and "type 3 size 4" in issue.message
+                for issue in issues
+            ),
+            issues,
+        )
+
+    def test_to_db_shards(self):
+        filenames = {name: f"_test_{name}.mmdb" for name in ("all", "a", "b", "none")}
+        self.extra_files += filenames.values()
+        writer = MMDBWriter()
+        values = [{"n": i, "country": {"name": f"c{i % 2}"}} for i in range(1, 5)]
+        for i, value in enumerate(values, 1):
+            writer.insert_network(IPSet([f"{i}.0.0.0/8"]), value)
+        with mock.patch("mmdb_writer.time.time", return_value=1):
+            writer.to_db_file(self.filename)
+            with mock.patch.object(
+                Encoder, "encode", autospec=True, side_effect=Encoder.encode
+            ) as encode:
+                writer.to_db_shards(
+                    {
+                        filenames["all"]: ["0.0.0.0/0"],
+                        filenames["a"]: IPSet(["1.0.0.0/8", "3.0.0.0/9"]),
+                        filenames["b"]: [
+                            IPv4Network("2.0.0.0/8"),
+                            (
+                                int(IPv4Address("1.128.0.0")),
+                                int(IPv4Address("1.255.255.255")),
+                            ),
+                        ],
+                        filenames["none"]: [],
+                    }
+                )
+        # every value is encoded once for each shard it is in: 4 + 2 + 2 + 0
+        encoded = [call.args[1] for call in encode.call_args_list]
+        self.assertEqual(8, sum(value in values for value in encoded))
+        self.assertFalse(any(isinstance(value, MmdbRaw) for value in encoded))
+        with open(self.filename, "rb") as f, open(filenames["all"], "rb") as f_all:
+            self.assertEqual(f.read(), f_all.read())
+
+        expected = {
+            "a": [1, 1, None, 3, None, None],
+            "b": [None, 1, 2, None, None, None],
+            "none": [None] * 6,
+        }
+        ips = ["1.1.1.1", "1.200.0.1", "2.1.1.1", "3.1.1.1", "3.200.0.1", "4.1.1.1"]
+        for name, values in expected.items():
+            with maxminddb.open_database(filenames[name]) as m:
+                self.assertEqual(values, [(m.get(ip) or {}).get("n") for ip in ips])
+            # no values of other shards are left in the data section
+            self.assertEqual([], verify_database(filenames[name], workers=1))
+
+    def test_insert_without_netaddr(self):
+        expected = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        expected.insert_network(IPSet(["1.0.0.0/8", "2001:db8::/32"]), record1)
+        expected.insert_network(IPSet(["1.1.0.0/16"]), record2)
+        writer = MMDBWriter(ip_version=6, ipv4_compatible=True)
+        writer.insert_network([IPv4Network("1.0.0.0/8"), "2001:db8::1/32"], record1)
+        writer.insert_network("1.1.0.0/16", record2)
+        self.assertEqual([], diff_databases(expected, writer))
+        writer.insert_network([(0xFFFF01020300, 120)], record2)
+        writer.insert_network(IPv6Address("::ffff:1.2.4.1"), record2)
+        # a bare tuple is one network, not a list of two
+        writer.insert_network((0xFFFF01020500, 120), record1)
+        for network in ("1.0.0.0/33", (1 << 128, 8), (-1, 8), (0, 129), (0, -1)):
+            with self.assertRaises(ValueError):
+                writer.insert_network([network], record2)
+        with self.assertRaises(ValueError):
+            MMDBWriter().insert_network([(1 << 32, 8)], record2)
+        writer.to_db_file(self.filename)
+        with maxminddb.open_database(self.filename) as m:
+            self.assertEqual(record1, m.get("1.2.0.1"))
+            self.assertEqual(record2, m.get("1.1.0.1"))
+            self.assertEqual(record2, m.get("::ffff:1.2.3.1"))
+            self.assertEqual(record2, m.get("::ffff:1.2.4.1"))
+            self.assertEqual(None, m.get("::ffff:1.2.4.2"))
+            self.assertEqual(record1, m.get("::ffff:1.2.5.1"))
+
+        # a /0 covers the whole address space
+        cases = [
+            (4, "0.0.0.0/0", "1.0.0.0/8", "200.0.0.1", "1.0.0.1"),
+            (6, [(0, 0)], "::/8", "fe80::1", "::1"),
+        ]
+        for ip_version, network, subnet, outside, inside in cases:
+            writer = MMDBWriter(ip_version=ip_version)
+            writer.insert_network(network, record1)
+            writer.insert_network(subnet, record2)
+            writer.to_db_file(self.filename)
+            with maxminddb.open_database(self.filename) as m:
+                self.assertEqual(record1, m.get(outside))
+                self.assertEqual(record2, m.get(inside))
+
+        # modules of optional features are not imported until they are used
+        lazy = {"netaddr", "asyncio", "gzip", "bz2", "lzma", "pickle", "json", "mmap"}
+        code = f"import sys, mmdb_writer; print({lazy!r} & set(sys.modules))"
+        output = subprocess.check_output([sys.executable, "-c", code], text=True)
+        self.assertEqual("set()\n", output)
+
+    def test_async_writer(self):
+        async def networks():
+            for i in range(256):
+                yield IPSet([f"1.{i}.0.0/16"]), {"n": i}
+
+        async def build():
+            writer = AsyncMMDBWriter(database_type="async")
+            await writer.insert_from(networks(), batch_size=10)
+            await writer.insert_network(IPSet(["2.0.0.0/8"]), record1)
+            await writer.to_db_file(self.filename)
+
+        asyncio.run(build())
+        with maxminddb.open_database(self.filename) as m:
+            self.assertEqual("async", m.metadata().database_type)
+            self.assertEqual({"n": 0}, m.get("1.0.0.1"))
+            self.assertEqual({"n": 255}, m.get("1.255.0.1"))
+            self.assertEqual(record1, m.get("2.0.0.1"))
+
+        async def build_concurrently():
+            with ThreadPoolExecutor(8) as executor:
+                writer = AsyncMMDBWriter(executor=executor)
+                await asyncio.gather(
+                    *(
+                        writer.insert_network(f"3.{i}.{j}.0/24", {"n": i * 256 + j})
+                        for i in range(16)
+                        for j in range(256)
+                    ),
+                    writer.to_db_file(self.filename),
+                    writer.insert_network("4.0.0.0/8", record2),
+                )
+
+        asyncio.run(build_concurrently())
+        with maxminddb.open_database(self.filename) as m:
+            for i in range(16):
+                for j in range(256):
+                    self.assertEqual({"n": i * 256 + j}, m.get(f"3.{i}.{j}.1"))
+            self.assertIsNone(m.get("4.0.0.1"))
+
+    def test_async_writer_cancel(self):
+        started, release = threading.Event(), threading.Event()
+        cal_node_bytes = TreeWriter._cal_node_bytes
+
+        def slow_cal_node_bytes(tree_writer, node):
+            started.set()
+            release.wait(5)
+            return cal_node_bytes(tree_writer, node)
+
+        async def build():
+            writer = AsyncMMDBWriter()
+            await writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+            task = asyncio.ensure_future(writer.to_db_file(self.filename))
+            await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+            task.cancel()
+            release.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with mock.patch.object(TreeWriter, "_cal_node_bytes", slow_cal_node_bytes):
+            asyncio.run(build())
+        self.assertFalse(os.path.exists(self.filename))
+
+        # a file is only removed once the write has started on it
+        writer = MMDBWriter()
+        writer.insert_network(IPSet(["1.0.0.0/8"]), record1)
+        writer.to_db_file(self.filename)
+        with open(self.filename, "rb") as f:
+            expected = f.read()
+        started.clear()
+        release.clear()
+        prepare = TreeWriter.prepare
+
+        def slow_prepare(tree_writer):
+            started.set()
+            release.wait(5)
+            prepare(tree_writer)
+
+        with mock.patch.object(TreeWriter, "prepare", slow_prepare):
+            asyncio.run(build())
+        with open(self.filename, "rb") as f:
+            self.assertEqual(expected, f.read())
@@ -10,6 +10,7 @@ import maxminddb
 from netaddr.ip.sets import IPSet
 
 from mmdb_writer import MmdbBaseType, MmdbF32, MMDBWriter
+from tests.bench_clients import VARIANTS, format_report, run_benchmarks
 from tests.record import Record
 
 logging.basicConfig(
@@ -129,3 +130,18 @@ class TestClients(unittest.TestCase):
             should_data, lambda x: base64.b64encode(x).decode()
         )
         self.assertDictEqual(should_data, go_data)
+
+    def test_bench_python(self):
+        results = run_benchmarks(
+            networks=200, records=20, lookups=100, clients=["python"], warmup=0
+        )
+        self.assertEqual(
+            list(VARIANTS), list(dict.fromkeys(r["variant"] for r in results))
+        )
+        for result in results:
+            self.assertTrue(result["client"].startswith("python"))
+            self.assertEqual(100, result["lookups"])
+            self.assertLessEqual(result["p50_ns"], result["p99_ns"])
+            expected_record_size = 32 if result["variant"] == "record_size=32" else 24
+            self.assertEqual(expected_record_size, result["record_size"])
+        self.assertEqual(len(results) + 1, len(format_report(results).splitlines()))